@@ -0,0 +1,393 @@
+"""
+Offline benchmarks for the red black tree. Times the tree's operations against a dict and a bisect-maintained
+sorted list across sizes and key orders, records the tree's shape and memory per entry, and writes the results
+as JSON so runs from different versions can be compared
+
+Run ``python benchmark.py --help`` for the options, for example
+``python benchmark.py --sizes 1e3 1e5 1e7 --output results.json --baseline previous.json``
+"""
+import argparse
+import bisect
+import gc
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from redblacktree import RedBlackTree
+
+#Inserting into or deleting from a Python list is a memmove of the whole tail, which makes sorted list writes
+#quadratic. Above this size they are skipped and recorded as None
+SORTED_LIST_WRITE_LIMIT = 10 ** 6
+
+ORDERS = ("sequential", "random", "adversarial")
+
+
+class DictNode(RedBlackTree.Node):
+    """
+    Node with a per-instance __dict__, the layout nodes had before they were slotted. Only used for comparison
+    """
+
+
+def memory_per_entry(n, node_class=None):
+    """
+    Returns the number of bytes the tree allocates per entry when n int keys are inserted
+    Keys and values are allocated up front, so only the tree's own structures are counted
+    :param n: the number of entries to insert
+    :param node_class: optional node class to build the tree with instead of RedBlackTree.Node
+    """
+    keys = list(range(n))
+    tree = RedBlackTree()
+    if node_class is not None:
+        tree.Node = node_class
+    return _traced_bytes(lambda: _fill_tree(tree, keys)) / n
+
+
+def _traced_bytes(build):
+    # Bytes still allocated after build() returns, measured with tracemalloc
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del result
+    return after - before
+
+
+def _fill_tree(tree, keys):
+    for key in keys:
+        tree.put(key, key)
+    return tree
+
+
+def key_order(n, order, seed):
+    """
+    Returns the keys 0..n-1 in the given insertion order
+    sequential is ascending, random is a seeded shuffle and adversarial alternates between the two ends
+    (0, n-1, 1, n-2, ...), which keeps every insertion on the outer spines of the tree
+    :param n: the number of keys
+    :param order: one of ORDERS
+    :param seed: seed for the random order
+    """
+    if order == "sequential":
+        return list(range(n))
+    if order == "random":
+        keys = list(range(n))
+        random.Random(seed).shuffle(keys)
+        return keys
+    if order == "adversarial":
+        keys = []
+        lo, hi = 0, n - 1
+        while lo <= hi:
+            keys.append(lo)
+            if lo != hi:
+                keys.append(hi)
+            lo += 1
+            hi -= 1
+        return keys
+    raise ValueError("unknown key order %r" % (order,))
+
+
+def _timed(fn, count):
+    # Runs fn() once with the garbage collector paused and returns nanoseconds per operation
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter_ns()
+        fn()
+        elapsed = time.perf_counter_ns() - start
+    finally:
+        gc.enable()
+    return elapsed / max(count, 1)
+
+
+def bench_tree(keys, queries, scan_width):
+    """
+    Times the tree operations, returning (nanoseconds per operation by name, shape metrics)
+    :param keys: the keys to insert, in insertion order
+    :param queries: keys to look up, all present in the tree
+    :param scan_width: number of keys covered by each range scan
+    """
+    n = len(keys)
+    tree = RedBlackTree()
+    results = {}
+    results["put"] = _timed(lambda: _fill_tree(tree, keys), n)
+    ranks = [q % n for q in queries]
+    scan_starts = queries[:max(1, len(queries) // scan_width)]
+
+    def run(fn, items):
+        for item in items:
+            fn(item)
+
+    results["get"] = _timed(lambda: run(tree.get, queries), len(queries))
+    results["contains_key"] = _timed(lambda: run(tree.contains_key, queries), len(queries))
+    results["find_rank"] = _timed(lambda: run(tree.find_rank, queries), len(queries))
+    results["select"] = _timed(lambda: run(tree.select, ranks), len(ranks))
+    results["find_predecessor"] = _timed(lambda: run(tree.find_predecessor, queries), len(queries))
+    results["find_successor"] = _timed(lambda: run(tree.find_successor, queries), len(queries))
+    results["lower"] = _timed(lambda: run(tree.lower, queries), len(queries))
+    results["higher"] = _timed(lambda: run(tree.higher, queries), len(queries))
+
+    def scans():
+        for start in scan_starts:
+            for _ in tree.irange(start, start + scan_width, (True, False)):
+                pass
+    results["range_scan"] = _timed(scans, len(scan_starts))
+    results["iterate"] = _timed(lambda: run(_ignore, tree.items()), n)
+
+    stats = tree.stats()
+    shape = {
+        "height": stats["height"],
+        "black_height": stats["black_height"],
+        "red_nodes": stats["red_nodes"],
+        "average_depth": stats["average_depth"],
+    }
+    results["delete"] = _timed(lambda: run(tree.delete, queries), len(queries))
+    return results, shape
+
+
+def bench_dict(keys, queries):
+    """
+    Times the equivalent dict operations, returning nanoseconds per operation by name
+    :param keys: the keys to insert, in insertion order
+    :param queries: keys to look up, all present
+    """
+    table = {}
+    results = {}
+
+    def fill():
+        for key in keys:
+            table[key] = key
+    results["put"] = _timed(fill, len(keys))
+
+    def get():
+        for q in queries:
+            table.get(q)
+    results["get"] = _timed(get, len(queries))
+
+    def contains():
+        for q in queries:
+            q in table
+    results["contains_key"] = _timed(contains, len(queries))
+
+    def delete():
+        for q in queries:
+            table.pop(q, None)
+    results["delete"] = _timed(delete, len(queries))
+    return results
+
+
+def bench_sorted_list(keys, queries, scan_width):
+    """
+    Times the equivalent operations on a sorted key list kept with bisect plus a parallel value list,
+    returning nanoseconds per operation by name
+    :param keys: the keys to insert, in insertion order
+    :param queries: keys to look up, all present
+    :param scan_width: number of keys covered by each range scan
+    """
+    n = len(keys)
+    writes = n <= SORTED_LIST_WRITE_LIMIT
+    sorted_keys = []
+    values = []
+    results = {}
+
+    def fill():
+        for key in keys:
+            i = bisect.bisect_left(sorted_keys, key)
+            sorted_keys.insert(i, key)
+            values.insert(i, key)
+    if writes:
+        results["put"] = _timed(fill, n)
+    else:
+        results["put"] = None
+        sorted_keys = sorted(keys)
+        values = list(sorted_keys)
+    ranks = [q % n for q in queries]
+    scan_starts = queries[:max(1, len(queries) // scan_width)]
+
+    def get():
+        for q in queries:
+            i = bisect.bisect_left(sorted_keys, q)
+            if i < n and sorted_keys[i] == q:
+                values[i]
+    results["get"] = _timed(get, len(queries))
+
+    def contains():
+        for q in queries:
+            i = bisect.bisect_left(sorted_keys, q)
+            i < n and sorted_keys[i] == q
+    results["contains_key"] = _timed(contains, len(queries))
+
+    def rank():
+        for q in queries:
+            bisect.bisect_left(sorted_keys, q)
+    results["find_rank"] = _timed(rank, len(queries))
+
+    def select():
+        for r in ranks:
+            sorted_keys[r]
+    results["select"] = _timed(select, len(ranks))
+
+    def lower():
+        for q in queries:
+            i = bisect.bisect_left(sorted_keys, q)
+            sorted_keys[i - 1] if i else None
+    results["lower"] = _timed(lower, len(queries))
+
+    def higher():
+        for q in queries:
+            i = bisect.bisect_right(sorted_keys, q)
+            sorted_keys[i] if i < n else None
+    results["higher"] = _timed(higher, len(queries))
+
+    def scans():
+        for start in scan_starts:
+            lo = bisect.bisect_left(sorted_keys, start)
+            hi = bisect.bisect_left(sorted_keys, start + scan_width)
+            for _ in zip(sorted_keys[lo:hi], values[lo:hi]):
+                pass
+    results["range_scan"] = _timed(scans, len(scan_starts))
+    results["iterate"] = _timed(lambda: _ignore_all(zip(sorted_keys, values)), n)
+
+    def delete():
+        for q in queries:
+            i = bisect.bisect_left(sorted_keys, q)
+            if i < len(sorted_keys) and sorted_keys[i] == q:
+                del sorted_keys[i]
+                del values[i]
+    results["delete"] = _timed(delete, len(queries)) if writes else None
+    return results
+
+
+def _ignore(item):
+    pass
+
+
+def _ignore_all(items):
+    for _ in items:
+        pass
+
+
+def container_memory_per_entry(n):
+    """
+    Returns bytes allocated per entry by the tree, by the same tree built from DictNode nodes (the layout before
+    nodes were slotted), by a dict and by a sorted key list with a parallel value list
+    :param n: the number of int entries
+    """
+    keys = list(range(n))
+    return {
+        "tree": memory_per_entry(n),
+        "tree_dict_nodes": memory_per_entry(n, DictNode),
+        "dict": _traced_bytes(lambda: {key: key for key in keys}) / n,
+        "sorted_list": _traced_bytes(lambda: (list(keys), list(keys))) / n,
+    }
+
+
+def run(sizes, orders=ORDERS, queries=10000, scan_width=100, seed=0, memory=True):
+    """
+    Runs the whole suite and returns the results as a JSON-ready dict
+    :param sizes: the tree sizes to measure
+    :param orders: the key insertion orders to measure, a subset of ORDERS
+    :param queries: the number of lookups timed per operation (capped at the size)
+    :param scan_width: number of keys covered by each range scan
+    :param seed: seed for the random key order and the query sample
+    :param memory: True to also measure memory per entry, which is slow for large sizes
+    """
+    results = {
+        "python": sys.version.split()[0],
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "seed": seed,
+        "runs": [],
+    }
+    for n in sizes:
+        query_keys = random.Random(seed + n).sample(range(n), min(queries, n))
+        for order in orders:
+            keys = key_order(n, order, seed)
+            tree_times, shape = bench_tree(keys, query_keys, scan_width)
+            results["runs"].append({
+                "size": n,
+                "order": order,
+                "ns_per_op": {
+                    "tree": tree_times,
+                    "dict": bench_dict(keys, query_keys),
+                    "sorted_list": bench_sorted_list(keys, query_keys, scan_width),
+                },
+                "shape": shape,
+            })
+        if memory:
+            results.setdefault("bytes_per_entry", {})[str(n)] = container_memory_per_entry(n)
+    return results
+
+
+def compare(current, baseline, tolerance):
+    """
+    Returns a list of (size, order, operation, baseline ns, current ns) for the tree operations that got slower
+    than the baseline by more than the tolerance
+    :param current: results from run()
+    :param baseline: results from an earlier run()
+    :param tolerance: allowed slowdown as a fraction, 0.1 for 10%
+    """
+    previous = {(r["size"], r["order"]): r["ns_per_op"]["tree"] for r in baseline["runs"]}
+    slower = []
+    for r in current["runs"]:
+        old = previous.get((r["size"], r["order"]))
+        if old is None:
+            continue
+        for op, ns in r["ns_per_op"]["tree"].items():
+            before = old.get(op)
+            if before and ns > before * (1 + tolerance):
+                slower.append((r["size"], r["order"], op, before, ns))
+    return slower
+
+
+def _print_summary(results):
+    for r in results["runs"]:
+        print("n=%d %s  height=%d black_height=%d" % (r["size"], r["order"], r["shape"]["height"],
+                                                     r["shape"]["black_height"]))
+        times = r["ns_per_op"]
+        for op, ns in times["tree"].items():
+            others = "".join("  %s=%s" % (name, "-" if times[name].get(op) is None else "%.0f" % times[name][op])
+                             for name in ("dict", "sorted_list") if op in times[name])
+            print("  %-16s tree=%.0f ns%s" % (op, ns, others))
+    for n, per_entry in results.get("bytes_per_entry", {}).items():
+        print("bytes per entry n=%s  " % n + "  ".join("%s=%.1f" % item for item in per_entry.items()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--sizes", nargs="+", type=float, default=[1e3, 1e4, 1e5],
+                        help="tree sizes to measure, e.g. 1e3 1e5 1e7")
+    parser.add_argument("--orders", nargs="+", choices=ORDERS, default=list(ORDERS))
+    parser.add_argument("--queries", type=int, default=10000, help="lookups timed per operation")
+    parser.add_argument("--scan-width", type=int, default=100, help="keys covered by each range scan")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true", help="skip the memory per entry measurement")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="slowdown against the baseline that counts as a regression (default 0.1)")
+    args = parser.parse_args(argv)
+
+    results = run([int(n) for n in args.sizes], args.orders, args.queries, args.scan_width, args.seed,
+                  not args.no_memory)
+    _print_summary(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f), args.tolerance)
+        for n, order, op, before, now in slower:
+            print("regression: n=%d %s %s %.0f ns -> %.0f ns" % (n, order, op, before, now))
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
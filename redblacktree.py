@@ -1,651 +1,4400 @@
-import tkinter as tk
-class RedBlackTree:
-    """
-    Red black tree object that maintains a balanced tree by adhering to certain rules on node placements
-    """
-    class Node:
-        def __init__(self, key, value, color):
-            #TODO organize helper methods
-            """
-            Class that represents the nodes of the red-black tree
-            :param key: The key that sorts the
-            :param value:
-            :param color:
-            """
-            self.key = key
-            self.value = value
-            #True is black, False is red
-            self.color = color
-            self.subtree_size = 1
-            #Node relation initialized as None because they haven't been placed yet
-            self.left = None
-            self.right = None
-            self.parent = None
-
-    def __init__(self):
-        """
-        The central red black tree object that self balances by maintaining black balance and other requirements
-        """
-        self.root = None
-        self.debug = False
-        self.total_size = 0
-        self.unwinding = False
-        self.last_del = None
-
-    def __len__(self):
-        return self.total_size
-
-    def put(self, key, value):
-        """
-        Places a node into it's place in the red black tree and then balances the tree recursively
-        :param key: the key for the node to be inserted
-        :param value: the value of the node to be inserted
-        """
-        # Calls the helper method to insert a new key-value pair while maintaining Red-Black Tree properties
-        self.root = self.__putRecursive(self.root, key, value)
-        self.total_size += 1
-        self.__update_subtree_size(self.root)
-        self.root.color = True  # Ensure root is black, can't affect any properties negatively
-
-    def __putRecursive(self, node, key, value):
-        #no root node case
-        if node is None:
-
-            self.unwinding = True
-            # Creates a new node to be the root
-            return self.Node(key, value, False)
-
-        # Recursive insertion
-        #case where key is already
-        if key == node.key:
-            node.value = value
-            #counteract the bump
-            self.total_size -= 1
-            return node
-        if key < node.key:
-            node.left = self.__putRecursive(node.left, key, value)
-        elif key > node.key:
-            node.right = self.__putRecursive(node.right, key, value)
-        if self.unwinding:
-            self.unwinding = False
-            if self.debug: self.display_tree()
-        # Check and enforce Red-Black Tree properties after insertion
-        if self.__is_red(node.right) and not self.__is_red(node.left):
-            node = self.__rotate_left(node)
-        if self.__is_red(node.left) and self.__is_red(node.left.left):
-            node = self.__rotate_right(node)
-        if self.__is_red(node.left) and self.__is_red(node.right):
-            self.__flip_colors(node)
-
-        #call the update subtree size method to make it so the subtree size values are correct post rotation
-        self.__update_subtree_size(node)
-
-        #returns the updated node
-        return node
-
-    def __is_red(self, node):
-        # Helper method that checks if a node is red
-        if node is None:
-            return False
-        return not node.color
-
-    def __is_black(self, node):
-        # Helper method that checks if a node is black
-        if node is None:
-            return False
-        return node.color
-
-    def __rotate_left(self, node):
-        #Left rotation in a Red-Black Tree. Used to balance the tree after an insertion or as part of other tree operations.
-
-        x = node.right
-        node.right = x.left
-        x.left = node
-        x.color = x.left.color
-        x.left.color = False
-        self.__update_subtree_size(node)
-        self.__update_subtree_size(x.left)
-
-
-        return x
-
-    def __rotate_right(self, node):
-        # Left rotation in a Red-Black Tree. Used to balance the tree after an insertion or as part of other tree operations.
-
-        x = node.left
-        node.left = x.right
-        x.right = node
-        x.color = x.right.color
-        x.right.color = False
-        self.__update_subtree_size(node)
-        self.__update_subtree_size(x.right)
-
-        return x
-
-    def __flip_colors(self, node):
-        """
-        Flips the colors of a "family" of nodes, maintaining black balance
-        :param node: The parent node of the "family"
-        """
-        node.color = not node.color
-        node.left.color = not node.left.color
-        node.right.color = not node.right.color
-
-    def get(self, key):
-        """
-        Returns the value corresponding to the given key, or None if the key is not present
-        :param key: the key to be searched for
-        """
-        node = self.root
-        while node is not None and (node.right is not None or node.left is not None or self.size == 1):
-            #check if we found the right key
-            if node.key == key:
-                return node.value
-            #if not go left or right
-            if node.key > key and node.left is not None:
-                node = node.left
-            elif node.key < key and node.right is not None:
-                node = node.right
-        if node.key == key: return node.value
-        return None
-        """
-        Removes a key-value pair, returning the deleted value
-        Returns None if the key wasn't present
-        :param key: the key to be deleted
-        :return:
-        """
-
-    def delete(self, key):
-        self.last_del = None  # Initialize last_del to None
-        if self.root is None:
-            return None
-
-        self.root.color = False  # Set the root node color to red
-
-        self.root = self.__delete_recursively(self.root, key)
-
-        if self.root is not None:
-            self.root.color = True  # Ensure the root is black after deletion
-        return self.last_del  # Return the value of the deleted node
-
-    def __delete_recursively(self, node, key):
-        if key < node.key:
-            if node.left is not None:
-                if not self.__is_red(node.left) and not self.__is_red(node.left.left):
-                    node = self.__move_red_left(node)
-                node.left = self.__delete_recursively(node.left, key)
-        else:
-            if self.__is_red(node.left):
-                node = self.__rotate_right(node)
-            if key == node.key and node.right is None:
-                self.last_del = node.value
-                self.total_size -= 1
-                return None  # This node will be deleted
-            if node.right is not None:
-                if not self.__is_red(node.right) and not self.__is_red(node.right.left):
-                    node = self.__move_red_right(node)
-                if key == node.key:
-                    min_node = self.__min(node.right)
-                    # Capture node data in temp variables
-                    deleted_node = RedBlackTree.Node(node.key, node.value, node.color)
-                    # Replace node values with min_node values
-                    node.value, node.key, node.color = min_node.value, min_node.key, min_node.color
-                    # Delete the minimum node recursively
-                    node.right = self.__delete_min(node.right)
-                    self.last_del = deleted_node.value
-                else:
-                    node.right = self.__delete_recursively(node.right, key)
-        # Return the node after calling the balancing method
-        node = self.__fix_up(node)
-        self.__update_subtree_size(node)  # Update the size of the subtree
-
-        return node
-
-    def __delete_min(self, node):
-        # Delete the minimal key in the subtree rooted at the given node
-        if node.left is None:
-            return None  # This node will be deleted
-        if not self.__is_red(node.left) and not self.__is_red(node.left.left):
-            node = self.__move_red_left(node)
-        node.left = self.__delete_min(node.left)
-        return self.__fix_up(node)
-
-    def __move_red_left(self, node):
-        # Move a red node from the left to the right
-        self.__flip_colors(node)
-        if self.__is_red(node.right.left):
-            node.right = self.__rotate_right(node.right)
-            node = self.__rotate_left(node)
-            self.__flip_colors(node)
-        return node
-
-    def __move_red_right(self, node):
-        # Move a red node from the right to the left
-        self.__flip_colors(node)
-        if self.__is_red(node.left.left):
-            node = self.__rotate_right(node)
-            self.__flip_colors(node)
-        return node
-
-    def __fix_up(self, node):
-        # Post deletion method to fix red black tree properties -- no Idea if this works right
-        if self.__is_red(node.left) and self.__is_red(node.right):
-            self.__flip_colors(node)
-        if self.__is_red(node.right):
-            node = self.__rotate_left(node)
-        if self.__is_red(node.left) and self.__is_red(node.left.left):
-            node = self.__rotate_right(node)
-        #Do a second check for a color flip
-        if self.__is_red(node.left) and self.__is_red(node.right):
-            self.__flip_colors(node)
-
-        self.__update_subtree_size(node)
-        return node
-
-    def __min(self, node):
-        # Helper method to find the minimal key for deletion
-        while node.left is not None:
-            node = node.left
-        return node
-
-    def __update_subtree_size(self, node):
-        if node is not None:
-            node.subtree_size = 1 + self.__get_subtree_size(node.left) + self.__get_subtree_size(node.right)
-
-    def __get_subtree_size(self, node):
-        if node is None:
-            return 0
-        return node.subtree_size
-
-
-    def contains_key(self, key):
-        """
-        Returns true if the key is present
-        :param key:
-        :return:
-        """
-        if self.root is not None:
-            curr = self.root
-            if curr.key == key: return True
-        else:
-            # If the root is none, then the tree is empty so we return false
-            return False
-        while (curr.left is not None or curr.right is not None):
-            if curr.key > key:
-                if curr.left is not None:
-                    curr = curr.left
-                #If the key larger but there is no node, we know it isnt in the tree
-                else: return False
-            elif curr.key < key:
-                if curr.right is not None:
-                    curr = curr.right
-                # If the key is smaller but there is no node, we know it isnt in the tree
-                else: return False
-            if curr.key == key:
-                return True
-        return False
-
-    def contains_value(self, value):
-        """
-        Returns true if the value is present
-        :param value: The value to search for
-        """
-        # Returns true if the value is present
-        if self.root is not None:
-            curr = self.root
-        else:
-            # If the root is none, then the tree is (hopefully) empty so we return none
-            return False
-        if curr.value == value:
-            return True
-        return self.__recursive_value_search(curr.left, value) or self.__recursive_value_search(curr.right, value)
-
-    def __recursive_value_search(self,node, value):
-        #helper method for the value search
-        if node is None:
-            return False
-        if node.value == value:
-            return True
-        else:
-            return self.__recursive_value_search(node.left, value) or self.__recursive_value_search(node.right, value)
-
-
-
-    def is_empty(self):
-        """
-        Returns true if the tree is empty
-        """
-        return self.total_size == 0
-
-    def size(self):
-        """
-        Returns the number of key-value pairs in the tree
-        """
-        return self.total_size
-
-    def reverse_lookup(self, value):
-        """
-        Finds the first key that maps to the value within the red black tree,
-        Returns None if there is none
-        """
-        # Finds a key that maps to the given value
-        #
-        return self.__reverseLookupHelper(self.root, value)
-
-    def __reverseLookupHelper(self, node, value):
-        if node is None:
-            return None
-
-        if node.value == value:
-            return node.key
-
-        # Check left and right subtrees
-        left_result = self.__reverseLookupHelper(node.left, value)
-        if left_result:
-            return left_result
-
-        right_result = self.__reverseLookupHelper(node.right, value)
-        if right_result:
-            return right_result
-
-        return None
-
-    def find_first_key(self):
-        """
-        Returns the key that is less than all the others
-        """
-        #Confirm the root is not None, so we can assign curr to it safely
-        if self.root is not None: curr = self.root
-
-        else:
-            # If the root is none, then the tree is (hopefully) empty so we return none
-            return None
-        while (curr.left is not None):
-            curr = curr.left
-        return curr.key
-
-    def find_last_key(self):
-        """
-        Returns the key that is less than all the others
-        """
-        # Confirm the root is not None, so we can assign curr to it safely
-        if self.root is not None:
-            curr = self.root
-        else:
-            # If the root is none, then the tree is empty so we return none
-            return None
-        while (curr.right is not None):
-            curr = curr.right
-        return curr.key
-
-    def get_root_key(self):
-        """
-        Returns the key contained in the root
-        """
-        # Confirm the root is not None, so we can access it safely
-        if self.root is not None:
-            return self.root.key
-        else:
-            # If the root is none, then the tree is (hopefully) empty so we return none
-            return None
-
-    def find_predecessor(self, key):
-        #
-        """
-        Returns the predecessor of the given key
-        Returns None if the key is not present or has no predecessor
-        :param key:
-        """
-        if self.root is not None:
-            curr = self.root
-        else:
-            # If the root is none, then the tree is empty so we return false
-            return None
-        #Keep track of last time we went right
-        last = self.root
-        while (curr.left is not None or curr.right is not None):
-
-            if curr.key > key:
-                if curr.left is not None:
-                    curr = curr.left
-                #If the key larger but there is no node, we know it isnt in the tree
-                else: return None
-            elif curr.key < key:
-                if curr.right is not None:
-                    #update last because we went right.
-                    last = curr
-                    curr = curr.right
-                # If the key is smaller but there is no node, we know it isnt in the tree
-                else: return None
-            if curr.key == key:
-                #once we find the key, we check to see if we can find the predecessor in the left subtree
-                if curr.left is not None:
-                    curr = curr.left
-                    while curr.right is not None:
-                        curr = curr.right
-                    return curr
-                #if not, then we have to grab the parent
-                return last
-        #Traverse tree to find key
-        return None
-
-    def find_successor(self, key):
-        """
-        Returns the successor of the given key or returns None if the key is not present or has no successor
-        :param key: the key to find the successor of
-        """
-        if self.root is not None:
-            curr = self.root
-        else:
-            # If the root is none, then the tree is empty so we return false
-            return None
-        #Keep track of last time we went left
-        last = self.root
-        while (curr.left is not None or curr.right is not None):
-            if curr.key > key:
-                if curr.left is not None:
-                    last = curr
-                    curr = curr.left
-                #If the key larger but there is no node, we know it isnt in the tree
-                else: return None
-            elif curr.key < key:
-                if curr.right is not None:
-                    curr = curr.right
-                # If the key is smaller but there is no node, we know it isnt in the tree
-                else: return None
-            if curr.key == key:
-                #once we find the key, we check to see if we can find the predecessor in the left subtree
-                if curr.right is not None:
-                    curr = curr.right
-                    while curr.left is not None:
-                        curr = curr.left
-                    return curr
-                #if not, then we have to grab the parent
-                return last
-        #Traverse tree to find key
-        return None
-
-
-    def find_rank(self, key):
-        """
-        Returns the rank of the given key, or returns -1 if the key is not present
-        :param key: the key to find the rank of
-        """
-        if self.root is not None:
-            curr = self.root
-        else:
-            # If the root is none, then the tree is empty so we return false
-            return -1
-        total = 0
-        while (curr.left is not None or curr.right is not None):
-            if curr.key > key:
-                if curr.left is not None:
-                    curr = curr.left
-                #If the key larger but there is no node, we know it isnt in the tree
-                else: return -1
-            elif curr.key < key:
-                if curr.right is not None:
-                    total += curr.left.subtree_size + 1
-                    curr = curr.right
-                # If the key is smaller but there is no node, we know it isnt in the tree
-                else: return -1
-            if curr.key == key:
-                if curr.left is None:
-                    return total
-                return total + curr.left.subtree_size
-        return -1
-
-    def select(self, rank):
-        """
-        Returns the key with the given rank
-        Returns None when the rank is invalid
-        :param rank: The rank of the object to be found
-        """
-        if self.root is not None:
-            curr = self.root
-        else:
-            return None
-
-        # Avoiding searching for a rank out of bounds
-        if rank >= self.size() or rank < 0:
-            return None
-
-        while True:
-            left_size = 0 if curr.left is None else curr.left.subtree_size
-            if rank < left_size:
-                curr = curr.left
-            elif rank == left_size:
-                return curr.key
-            elif curr.right is not None:
-                # Go right and adjust the rank to look in the right subtree
-                rank -= (left_size + 1)
-                curr = curr.right
-        return None
-
-    def count_red_nodes(self):
-        """
-        Returns the number of red nodes in the tree
-        """
-        #
-        if self.root is None:
-            return 0
-        return self.__recursive_count_red_nodes(self.root)
-
-    def __recursive_count_red_nodes(self, node):
-        if node is None:
-            return 0
-        count = self.__recursive_count_red_nodes(node.left) + self.__recursive_count_red_nodes(node.right)
-        if not node.color:
-            count += 1
-        return count
-
-    def calc_height(self):
-        """
-        Returns the height of the tree from the root through the longest chain
-        """
-
-
-        if self.root is None:
-            return 0
-        else:
-            # Subtract 1 as the root node is at height 1
-            return self.__recursive_calc_height(self.root) - 1
-
-    def __recursive_calc_height(self, node):
-        if node is None:
-            # we've reached a leaf/end
-            return 0
-
-        # Calculate the height of the left and right subtrees
-        left_height = self.__recursive_calc_height(node.left)
-        right_height = self.__recursive_calc_height(node.right)
-
-        # Return the maximum height plus one for the current node
-        return max(left_height, right_height) + 1
-
-
-    def calc_black_height(self):
-        """
-        Returns the black height of the tree, or 0 for an empty tree
-        :return:
-        """
-        curr = self.root
-        total = 0
-        while curr is not None:
-            #if the current node is black, increment the counter by 1
-            if self.__is_black(curr):
-                total +=1
-            if curr.left is not None:
-                curr = curr.left
-            elif curr.right is not None:
-                curr = curr.right
-            else: return total
-
-    def calc_average_depth(self):
-        """
-        Returns the average distance of all nodes to the root
-        """
-        if self.root is not None:
-            return self.__recursive_average_depth(self.root, 0) / self.size()
-        else:
-            return float('nan')
-
-    def __recursive_average_depth(self, node, depth):
-        if node is None:
-            return 0
-
-        # If the node is a leaf node, return its depth
-        if node.left is None and node.right is None:
-            return depth
-
-        # Calculate the sum of depths for both left and right subtrees
-        left_depth = self.__recursive_average_depth(node.left, depth + 1)
-        right_depth = self.__recursive_average_depth(node.right, depth + 1)
-
-        return left_depth + right_depth
-
-    def display_tree(self):
-        #Method I made for looking at small (>100) trees, definately could modify to work for bigger but I'm lazy
-
-        def __plot_tree(node, x, y, dx):
-            if node is not None:
-                radius = 10
-                color = "black" if node.color else "red"
-                canvas.create_oval(x - radius, y - radius, x + radius, y + radius, fill=color)
-                canvas.create_text(x, y, text=str(node.key))
-                canvas.create_text(x + 30, y, text=str(node.value))
-
-                if node.left:
-                    x_left = x - dx
-                    y_left = y + 25
-                    canvas.create_line(x, y + radius, x_left, y_left - radius)
-                    __plot_tree(node.left, x_left, y_left, dx / 2)
-
-                if node.right:
-                    x_right = x + dx
-                    y_right = y + 25
-                    canvas.create_line(x, y + radius, x_right, y_right - radius)
-                    __plot_tree(node.right, x_right, y_right, dx / 2)
-
-        if self.root is not None:
-            root_window = tk.Tk()
-            root_window.title("Red-Black Tree Visualization")
-
-
-
-            tree_width = self.__get_tree_width(self.root) * 20  # Calculate tree width
-            x_root = tree_width // 2  # Center x coordinate
-            y_root = 50  # Y coordinate
-
-            canvas = tk.Canvas(root_window, width=tree_width * 200, height=600)
-            canvas.pack()
-
-            __plot_tree(self.root, x_root, y_root, x_root // 2)  # Use x_root as starting x-coordinate
-
-            root_window.mainloop()
-
-    def __get_tree_width(self, node):
-        if node is None:
-            return 0
-        return 1 + self.__get_tree_width(node.left) + self.__get_tree_width(node.right)
-
+import bisect
+import collections
+import contextlib
+import gc
+import mmap
+import multiprocessing
+import os
+import pickle
+import struct
+import sys
+import threading
+import time
+import zlib
+
+#Stands in for the value of an entry deleted in lazy delete mode until the next compaction removes its node
+_TOMBSTONE = object()
+
+class RedBlackTree:
+    """
+    Red black tree object that maintains a balanced tree by adhering to certain rules on node placements
+    """
+    class Node:
+        #Fixed attribute layout instead of a per-node __dict__, which was most of the memory per entry
+        __slots__ = ("key", "value", "color", "subtree_size", "aggregate", "left", "right", "parent")
+
+        def __init__(self, key, value, color):
+            """
+            Class that represents the nodes of the red-black tree
+            :param key: The key that sorts the node within the tree
+            :param value: The value stored under the key
+            :param color: True for black, False for red
+            """
+            self.key = key
+            self.value = value
+            #True is black, False is red
+            self.color = color
+            self.subtree_size = 1
+            #Combined aggregate of the subtree, only maintained when the tree was created with an aggregate
+            self.aggregate = None
+            #Node relation initialized as None because they haven't been placed yet
+            self.left = None
+            self.right = None
+            self.parent = None
+
+    class Cursor:
+        """
+        Position within a red black tree that steps to neighboring entries in O(1) amortized time
+        The tree must not be modified while a cursor over it is in use
+        """
+        __slots__ = ("node",)
+
+        def __init__(self, node):
+            """
+            :param node: the node the cursor starts on, or None for a cursor past either end
+            """
+            self.node = node
+
+        @property
+        def valid(self):
+            """
+            True while the cursor is on an entry, False once it has stepped off either end
+            """
+            return self.node is not None
+
+        @property
+        def key(self):
+            """
+            The key under the cursor, or None when the cursor is not valid
+            """
+            return None if self.node is None else self.node.key
+
+        @property
+        def value(self):
+            """
+            The value under the cursor, or None when the cursor is not valid
+            """
+            return None if self.node is None else self.node.value
+
+        def next(self):
+            """
+            Moves to the next larger key, returning True if the cursor is still on an entry
+            """
+            node = self.node
+            if node is None:
+                return False
+            #steps once, and on over any entries deleted in lazy delete mode
+            while True:
+                if node.right is not None:
+                    node = node.right
+                    while node.left is not None:
+                        node = node.left
+                else:
+                    parent = node.parent
+                    while parent is not None and parent.right is node:
+                        node = parent
+                        parent = node.parent
+                    node = parent
+                if node is None or node.value is not _TOMBSTONE:
+                    break
+            self.node = node
+            return node is not None
+
+        def prev(self):
+            """
+            Moves to the next smaller key, returning True if the cursor is still on an entry
+            """
+            node = self.node
+            if node is None:
+                return False
+            while True:
+                if node.left is not None:
+                    node = node.left
+                    while node.right is not None:
+                        node = node.right
+                else:
+                    parent = node.parent
+                    while parent is not None and parent.left is node:
+                        node = parent
+                        parent = node.parent
+                    node = parent
+                if node is None or node.value is not _TOMBSTONE:
+                    break
+            self.node = node
+            return node is not None
+
+    class Instrumentation:
+        """
+        Per-operation counters and latency histograms, collected while RedBlackTree.enable_instrumentation() is on
+        Counters per operation: calls, rotations, color_flips, move_red_left, move_red_right, search_nodes and
+        search_comparisons. The last two are counted by the operations' own descents: the lookups of get,
+        contains_key and delete, the insert path of put, delete's top-down pass and successor descent, the spine
+        walks of pop_min and pop_max, the merged descent of get_many and contains_many (without the comparisons made
+        inside bisect) and the split walks of split, delete_range and pop_range. The other operations record none.
+        An operation called from inside another one, such as put from put_many, is charged to the outer operation
+        Latencies go into power of two buckets: bucket b counts the calls that took between 2^(b-1) and 2^b ns
+        """
+        COUNTERS = ("calls", "rotations", "color_flips", "move_red_left", "move_red_right", "search_nodes",
+                    "search_comparisons")
+
+        def __init__(self):
+            self.counters = {}
+            self.latency = {}
+            #name of the operation currently running, structural counts are charged to it
+            self.current = None
+
+        def counts(self, operation):
+            """
+            Returns the counter dict of an operation, creating it on first use
+            :param operation: the operation name, such as "put"
+            """
+            counts = self.counters.get(operation)
+            if counts is None:
+                counts = self.counters[operation] = dict.fromkeys(self.COUNTERS, 0)
+                self.latency[operation] = [0] * 65
+            return counts
+
+        def record_search(self, nodes, comparisons):
+            """
+            Adds the nodes visited and key comparisons of a descent to the operation that is running
+            :param nodes: the nodes visited
+            :param comparisons: the key comparisons made
+            """
+            counts = self.counts(self.current or "other")
+            counts["search_nodes"] += nodes
+            counts["search_comparisons"] += comparisons
+
+        def record_latency(self, operation, elapsed_ns):
+            """
+            Adds one latency sample to the histogram of an operation
+            :param operation: the operation name
+            :param elapsed_ns: the duration of the call in nanoseconds
+            """
+            self.latency[operation][min(int(elapsed_ns).bit_length(), 64)] += 1
+
+        def percentile(self, operation, fraction):
+            """
+            Returns an upper bound in nanoseconds for the given latency percentile of an operation,
+            taken from the histogram bucket it falls in, or None if the operation was never called
+            :param operation: the operation name
+            :param fraction: the percentile as a fraction, 0.99 for p99
+            """
+            buckets = self.latency.get(operation)
+            if not buckets:
+                return None
+            total = sum(buckets)
+            if total == 0:
+                return None
+            seen = 0
+            for bucket, count in enumerate(buckets):
+                seen += count
+                if seen >= fraction * total:
+                    return (1 << bucket) - 1 if bucket else 0
+            return (1 << 64) - 1
+
+        def summary(self):
+            """
+            Returns a dict of operation name to its counters plus p50_ns, p99_ns and p999_ns
+            """
+            result = {}
+            for operation, counts in self.counters.items():
+                entry = dict(counts)
+                entry["p50_ns"] = self.percentile(operation, 0.5)
+                entry["p99_ns"] = self.percentile(operation, 0.99)
+                entry["p999_ns"] = self.percentile(operation, 0.999)
+                result[operation] = entry
+            return result
+
+        def reset(self):
+            """
+            Clears every counter and histogram
+            """
+            self.counters = {}
+            self.latency = {}
+
+    class Journal:
+        """
+        Append-only write-ahead log of the changes to a tree, attached with RedBlackTree.attach_journal()
+        Every put, delete and range removal is appended as a checksummed record before it is applied. Records are
+        fsynced in groups: once group_size records are pending or group_interval seconds have passed since the last
+        sync, so a crash loses at most the last unsynced group. The interval is only checked when the next record is
+        written, so after writes stop up to group_size - 1 records stay unsynced until sync() or close() is called.
+        When the log grows past compact_bytes the tree is written to a dump() snapshot next to it and the log starts
+        over, always between two operations and never in the middle of a batch
+        """
+        #operation code, payload length, crc32 of the payload
+        RECORD = struct.Struct("<BII")
+        PUT = 1
+        DELETE = 2
+        DELETE_RANGE = 3
+
+        def __init__(self, tree, path, group_size=64, group_interval=0.01, compact_bytes=64 * 2 ** 20):
+            """
+            :param tree: the tree being logged
+            :param path: the log file; the snapshot is kept at path + ".snapshot"
+            :param group_size: the number of records after which the log is fsynced
+            :param group_interval: the seconds after which pending records are fsynced on the next write
+            :param compact_bytes: the log size after which the tree is snapshotted and the log cleared
+            """
+            self.tree = tree
+            self.path = str(path)
+            self.snapshot_path = self.path + ".snapshot"
+            self.group_size = group_size
+            self.group_interval = group_interval
+            self.compact_bytes = compact_bytes
+            self.file = None
+            self.log_bytes = 0
+            self.pending = 0
+            self.last_sync = time.monotonic()
+            self.syncs = 0
+            self.compactions = 0
+
+        def replay(self):
+            """
+            Applies the snapshot and then the log to the tree, returning the number of log records replayed
+            A torn or corrupt record at the end of the log, left by a crash during a write, ends the replay and is
+            cut off the file
+            """
+            tree = self.tree
+            if os.path.exists(self.snapshot_path):
+                with open(self.snapshot_path, "rb") as file:
+                    data = file.read()
+                options, count, position = TreeFile.read_header(data)
+                tree.put_many(TreeFile.read_records(data, count, position))
+            if not os.path.exists(self.path):
+                return 0
+            with open(self.path, "rb") as file:
+                data = file.read()
+            view = memoryview(data)
+            header = self.RECORD
+            position = 0
+            replayed = 0
+            while position + header.size <= len(data):
+                operation, length, checksum = header.unpack_from(view, position)
+                start = position + header.size
+                payload = view[start:start + length]
+                if len(payload) < length or zlib.crc32(payload) != checksum:
+                    break
+                argument = pickle.loads(payload)
+                if operation == self.PUT:
+                    tree.put(*argument)
+                elif operation == self.DELETE:
+                    tree.delete(argument)
+                else:
+                    tree.delete_range(*argument)
+                position = start + length
+                replayed += 1
+            if position < len(data):
+                with open(self.path, "r+b") as file:
+                    file.truncate(position)
+            return replayed
+
+        def open(self):
+            """
+            Opens the log for appending
+            """
+            self.file = open(self.path, "ab")
+            self.log_bytes = self.file.tell()
+            self.last_sync = time.monotonic()
+
+        def record_put(self, key, value):
+            """
+            Appends a put record
+            :param key: the key being put
+            :param value: the value being put
+            """
+            self.__maybe_compact()
+            self.__append(self.PUT, (key, value))
+            self.__maybe_sync()
+
+        def record_puts(self, items):
+            """
+            Appends a put record for each (key, value) pair of a batch, syncing at most once
+            :param items: list of (key, value) pairs
+            """
+            self.__maybe_compact()
+            for item in items:
+                self.__append(self.PUT, item)
+            self.__maybe_sync()
+
+        def record_delete(self, key):
+            """
+            Appends a delete record
+            :param key: the key being deleted
+            """
+            self.__maybe_compact()
+            self.__append(self.DELETE, key)
+            self.__maybe_sync()
+
+        def record_delete_range(self, lo, hi, inclusive):
+            """
+            Appends a range removal record
+            :param lo: the lower bound, or None
+            :param hi: the upper bound, or None
+            :param inclusive: pair of booleans saying whether lo and hi themselves are removed
+            """
+            self.__maybe_compact()
+            self.__append(self.DELETE_RANGE, (lo, hi, inclusive))
+            self.__maybe_sync()
+
+        def __maybe_compact(self):
+            # Compacts a log past its threshold before the first record of an operation, while the tree still
+            # matches it: every earlier change has been applied and this one not yet. Checking per record instead
+            # would snapshot a tree missing the first half of a batch and then truncate those records away
+            if self.log_bytes >= self.compact_bytes:
+                self.compact()
+
+        def __append(self, operation, argument):
+            # Writes one record to the file buffer
+            payload = pickle.dumps(argument, pickle.HIGHEST_PROTOCOL)
+            self.file.write(self.RECORD.pack(operation, len(payload), zlib.crc32(payload)) + payload)
+            self.log_bytes += self.RECORD.size + len(payload)
+            self.pending += 1
+
+        def __maybe_sync(self):
+            # Group commit: one fsync covers every record written since the previous one
+            if self.pending >= self.group_size or time.monotonic() - self.last_sync >= self.group_interval:
+                self.sync()
+
+        def sync(self):
+            """
+            Flushes and fsyncs every pending record
+            """
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.pending = 0
+            self.last_sync = time.monotonic()
+            self.syncs += 1
+
+        def compact(self):
+            """
+            Writes the whole tree to the snapshot file and empties the log
+            Replaying a log over a snapshot that already contains its changes gives the same tree, so a crash
+            between writing the snapshot and clearing the log is harmless
+            """
+            self.file.flush()
+            self.tree.dump(self.snapshot_path)
+            self.file.truncate(0)
+            os.fsync(self.file.fileno())
+            self.log_bytes = 0
+            self.pending = 0
+            self.last_sync = time.monotonic()
+            self.compactions += 1
+
+        def close(self):
+            """
+            Syncs and closes the log
+            """
+            if self.file is not None:
+                self.sync()
+                self.file.close()
+                self.file = None
+
+    class FrontCache:
+        """
+        Bounded LRU map from recently looked up keys to their nodes, or to None for keys that were absent, kept in
+        front of get and contains_key by RedBlackTree.enable_front_cache(). A hit is one hash probe instead of a
+        descent. Nodes keep their identity when values are overwritten, so only inserts, removals and bulk
+        rebuilds have to invalidate entries
+        """
+
+        def __init__(self, capacity, find_node):
+            """
+            :param capacity: the most keys kept
+            :param find_node: the tree's lookup, returning the node for a key or None
+            """
+            self.capacity = capacity
+            self.entries = collections.OrderedDict()
+            self.find_node = find_node
+            self.hits = 0
+            self.misses = 0
+
+        def lookup(self, key):
+            """
+            Returns the node holding key or None, from the cache when it can
+            :param key: the key to look up
+            """
+            entries = self.entries
+            try:
+                node = entries[key]
+            except KeyError:
+                self.misses += 1
+                node = entries[key] = self.find_node(key)
+                if len(entries) > self.capacity:
+                    entries.popitem(last=False)
+                return node
+            entries.move_to_end(key)
+            self.hits += 1
+            return node
+
+        def discard(self, key):
+            """
+            Forgets a key whose presence in the tree changed
+            :param key: the key inserted or removed
+            """
+            self.entries.pop(key, None)
+
+        def clear(self):
+            """
+            Forgets every key, after the tree was rebuilt or restructured in bulk
+            """
+            self.entries.clear()
+
+        def hit_rate(self):
+            """
+            Returns the fraction of lookups answered from the cache, or 0.0 before any lookup
+            """
+            total = self.hits + self.misses
+            return self.hits / total if total else 0.0
+
+        def counters(self):
+            """
+            Returns the hit and miss counts, the hit rate and the number of cached keys
+            """
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate(), "size": len(self.entries)}
+
+    def __init__(self, index_values=False, aggregate=None, key_dtype=None, lazy_delete=None):
+        """
+        The central red black tree object that self balances by maintaining black balance and other requirements
+        :param index_values: True to keep a reverse index from values to the keys holding them, which makes
+        contains_value and reverse_lookup O(1) on average. Values must then be hashable
+        :param aggregate: optional monoid kept for every subtree so aggregate(lo, hi) runs in O(log n), given as
+        (combine, identity) or (combine, identity, lift). combine must be associative and is applied in key order,
+        lift turns a value into an element and defaults to the value itself.
+        For example (operator.add, 0) keeps range sums and (operator.add, 0, lambda v: v > 10) counts large values
+        :param key_dtype: optional NumPy numeric dtype such as "int64" or "float64" for typed key mode. Keys are then
+        stored as plain Python numbers and get_many, contains_many, rank_many and count_range accept NumPy arrays,
+        answering from a contiguous sorted key buffer with vectorized binary searches. Writing a key the dtype cannot
+        hold, such as 1.5 or -1 for an integer dtype or a value out of its range, raises ValueError. Requires NumPy
+        :param lazy_delete: optional fraction between 0 and 1 that turns on lazy delete mode. delete then only marks
+        the entry as a tombstone in O(log n), without any rotation, and lookups, ranks and iteration skip it. Once
+        tombstones make up more than this fraction of the nodes the tree is rebuilt from the live entries in O(n)
+        """
+        if lazy_delete is not None and not 0 < lazy_delete <= 1:
+            raise ValueError("lazy_delete must be a fraction greater than 0 and at most 1")
+        self.root = None
+        self.debug = False
+        self.total_size = 0
+        self.lazy_delete = lazy_delete
+        #nodes still linked into the tree whose entry was deleted in lazy delete mode; total_size and every
+        #subtree_size count the live entries only
+        self.tombstones = 0
+        #the nodes holding the smallest and largest live keys, kept up to date by every write so peeking is O(1)
+        self.__first = None
+        self.__last = None
+        #value -> dict of the keys holding that value (a dict so the keys stay in insertion order)
+        self.value_index = {} if index_values else None
+        if aggregate is not None and len(aggregate) == 2:
+            aggregate = (aggregate[0], aggregate[1], RedBlackTree.__lift_value)
+        self.aggregate_ops = None if aggregate is None else tuple(aggregate)
+        #set while enable_instrumentation() is on
+        self.instrumentation = None
+        #set while a journal is attached
+        self.journal = None
+        #set while enable_front_cache() is on
+        self.front_cache = None
+        self.key_dtype = None
+        self.__key_cast = None
+        #(smallest, largest) finite key the dtype can hold
+        self.__key_range = None
+        #[sorted key array, value array or None] for typed key mode, dropped on every write and rebuilt on demand
+        self.__numeric_snapshot = None
+        if key_dtype is not None:
+            dtype = RedBlackTree.__numpy().dtype(key_dtype)
+            if dtype.kind not in "iuf":
+                raise ValueError("key_dtype must be an integer or floating point dtype")
+            self.key_dtype = dtype
+            self.__key_cast = float if dtype.kind == "f" else int
+            info = RedBlackTree.__numpy().finfo(dtype) if dtype.kind == "f" else RedBlackTree.__numpy().iinfo(dtype)
+            self.__key_range = (self.__key_cast(info.min), self.__key_cast(info.max))
+
+    def __len__(self):
+        return self.total_size
+
+    def put(self, key, value):
+        """
+        Places a node into it's place in the red black tree and then balances the tree by walking back up
+        the parent links of the insertion path
+        :param key: the key for the node to be inserted
+        :param value: the value of the node to be inserted
+        """
+        if self.key_dtype is not None:
+            key = self.__typed_key(key)
+            self.__numeric_snapshot = None
+        if self.value_index is not None:
+            #an unhashable value has to be refused before the journal or the tree is touched
+            hash(value)
+        #the journal record is written once the descent has compared the key all the way down, so a key that
+        #cannot be compared with the tree's keys never reaches the log
+        parent = None
+        node = self.root
+        went_left = False
+        while node is not None:
+            node_key = node.key
+            if key < node_key:
+                parent = node
+                node = node.left
+                went_left = True
+            elif node_key < key:
+                parent = node
+                node = node.right
+                went_left = False
+            else:
+                if self.instrumentation is not None:
+                    self.__record_path(node, 2)
+                if self.journal is not None:
+                    self.journal.record_put(key, value)
+                if node.value is _TOMBSTONE:
+                    #a key deleted in lazy delete mode comes back in the node it left behind
+                    self.__revive(node, value)
+                    return
+                #case where key is already present, only the value changes
+                old = node.value
+                if self.value_index is not None and not (old is value or old == value):
+                    self.__index_add(key, value)
+                    self.__index_remove(key, old)
+                node.value = value
+                if self.aggregate_ops is not None:
+                    while node is not None:
+                        self.__update_subtree_size(node)
+                        node = node.parent
+                return
+
+        if self.instrumentation is not None and parent is not None:
+            self.__record_path(parent, 1 if went_left else 2)
+        if self.journal is not None:
+            self.journal.record_put(key, value)
+        node = self.Node(key, value, False)
+        self.total_size += 1
+        if self.front_cache is not None:
+            self.front_cache.discard(key)
+        if self.value_index is not None:
+            self.__index_add(key, value)
+        if self.aggregate_ops is not None:
+            node.aggregate = self.aggregate_ops[2](value)
+        if self.__first is None or key < self.__first.key:
+            self.__first = node
+        if self.__last is None or self.__last.key < key:
+            self.__last = node
+        if parent is None:
+            #no root node case, the new node becomes the (black) root
+            node.color = True
+            self.root = node
+            return
+        node.parent = parent
+        if went_left:
+            parent.left = node
+        else:
+            parent.right = node
+        if self.debug: self.display_tree()
+        self.__fix_insert(parent)
+
+    def __fix_insert(self, node):
+        # Walks up from the parent of a freshly attached red leaf, enforcing the Red-Black Tree properties.
+        # Once a subtree comes back with a black top nothing above it can need a rotation or a flip,
+        # so the rest of the walk only bumps the subtree sizes (and recomputes aggregates, when kept)
+        aggregating = self.aggregate_ops is not None
+        while True:
+            node.subtree_size += 1
+            if aggregating:
+                self.__update_aggregate(node)
+            left = node.left
+            right = node.right
+            if right is not None and not right.color and (left is None or left.color):
+                node = self.__rotate_left(node)
+                left = node.left
+            if left is not None and not left.color and left.left is not None and not left.left.color:
+                node = self.__rotate_right(node)
+                left = node.left
+            right = node.right
+            if left is not None and not left.color and right is not None and not right.color:
+                self.__flip_colors(node)
+
+            parent = node.parent
+            if parent is None:
+                self.root = node
+                node.color = True  # Ensure root is black, can't affect any properties negatively
+                return
+            if node.color:
+                break
+            node = parent
+
+        node = parent
+        while node is not None:
+            node.subtree_size += 1
+            if aggregating:
+                self.__update_aggregate(node)
+            node = node.parent
+
+    @classmethod
+    def from_sorted(cls, items, **options):
+        """
+        Builds a tree from (key, value) pairs given in ascending key order in linear time, without any rebalancing
+        When a key repeats, the last value given for it is kept
+        Raises ValueError if the keys are not in ascending order
+        :param items: iterable of (key, value) pairs sorted by key
+        :param options: constructor options for the new tree, such as index_values
+        """
+        tree = cls(**options)
+        if tree.key_dtype is not None:
+            items = ((tree.__typed_key(key), value) for key, value in items)
+        nodes = []
+        last = None
+        for key, value in items:
+            if last is not None:
+                if key < last.key:
+                    raise ValueError("from_sorted() requires keys in ascending order")
+                if not last.key < key:
+                    last.value = value
+                    continue
+            last = tree.Node(key, value, True)
+            nodes.append(last)
+        tree.__link_sorted_nodes(nodes)
+        return tree
+
+    def put_many(self, items):
+        """
+        Inserts a batch of (key, value) pairs, in any order
+        Small batches are put one at a time; a batch that is large next to the tree is sorted, merged with the
+        existing nodes and rebuilt in linear time. When a key repeats, the last value given for it is kept
+        :param items: iterable of (key, value) pairs
+        """
+        batch = list(items)
+        if not batch:
+            return
+        if self.key_dtype is not None:
+            batch = [(self.__typed_key(key), value) for key, value in batch]
+        if self.value_index is not None:
+            for key, value in batch:
+                hash(value)
+        #Repeated puts cost about len(batch) * height, a rebuild about size + len(batch), and a rebuild step is
+        #roughly three times as expensive as one level of a put
+        if len(batch) * self.total_size.bit_length() < 3 * self.total_size:
+            for key, value in batch:
+                self.put(key, value)
+            return
+
+        #sort is stable, so among equal keys the last pair given ends up last
+        batch.sort(key=lambda item: item[0])
+        #only live nodes take part, so the rebuild also drops any tombstones
+        existing = list(self.__in_order_nodes())
+        merged = []
+        #(existing node, new value), applied only once every key has been compared without an error
+        updates = []
+        i = 0
+        n = len(existing)
+        for key, value in batch:
+            while i < n and existing[i].key < key:
+                merged.append(existing[i])
+                i += 1
+            if i < n and not key < existing[i].key:
+                #key already in the tree, overwrite and keep the node
+                updates.append((existing[i], value))
+                merged.append(existing[i])
+                i += 1
+            elif merged and not merged[-1].key < key:
+                #repeated key within the batch
+                if updates and updates[-1][0] is merged[-1]:
+                    updates[-1] = (merged[-1], value)
+                else:
+                    merged[-1].value = value
+            else:
+                merged.append(self.Node(key, value, True))
+        if self.journal is not None:
+            self.journal.record_puts(batch)
+        for node, value in updates:
+            node.value = value
+        merged.extend(existing[i:])
+        self.__link_sorted_nodes(merged)
+
+    def __link_sorted_nodes(self, nodes):
+        # Replaces the whole tree with the given nodes, which must already be in ascending key order
+        self.__numeric_snapshot = None
+        if self.front_cache is not None:
+            self.front_cache.clear()
+        self.total_size = len(nodes)
+        self.tombstones = 0
+        n = len(nodes)
+        if n == 0:
+            self.root = None
+            self.__first = self.__last = None
+            if self.value_index is not None:
+                self.value_index = {}
+            return
+        self.__first = nodes[0]
+        self.__last = nodes[-1]
+        #the black height is the largest h with 2^h - 1 <= n, which also guarantees n <= 3^h - 1
+        height = (n + 1).bit_length() - 1
+        self.root = RedBlackTree.__build_balanced(nodes, 0, n, height)
+        self.root.parent = None
+        if self.aggregate_ops is not None:
+            #nodes are in key order, so every node's children sit before its parent in a post-order walk
+            for node in self.__post_order_nodes(self.root):
+                self.__update_aggregate(node)
+        if self.value_index is not None:
+            self.__rebuild_value_index()
+
+    @staticmethod
+    def __build_balanced(nodes, lo, hi, black_height):
+        """
+        Links nodes[lo:hi] into a left leaning red black subtree with the given black height
+        Every subtree is laid out as a 2-3 tree node: a single black node, or a black node with a red left child
+        when there are too many keys for two children of the next black height down
+        :param nodes: nodes in ascending key order
+        :param lo: index of the first node of the subtree
+        :param hi: index one past the last node of the subtree
+        :param black_height: the number of black nodes on every path down from the subtree root
+        """
+        n = hi - lo
+        if black_height == 0:
+            return None
+        #the most keys a child subtree one black level down can hold
+        child_max = 3 ** (black_height - 1) - 1
+        if n - 1 <= 2 * child_max:
+            mid = lo + (n - 1) // 2
+            top = nodes[mid]
+            left = RedBlackTree.__build_balanced(nodes, lo, mid, black_height - 1)
+            right = RedBlackTree.__build_balanced(nodes, mid + 1, hi, black_height - 1)
+            top.left = left
+        else:
+            rest = n - 2
+            first = rest // 3
+            second = (rest - first) // 2
+            red_index = lo + first
+            top_index = red_index + 1 + second
+            red = nodes[red_index]
+            top = nodes[top_index]
+            red_left = RedBlackTree.__build_balanced(nodes, lo, red_index, black_height - 1)
+            red_right = RedBlackTree.__build_balanced(nodes, red_index + 1, top_index, black_height - 1)
+            right = RedBlackTree.__build_balanced(nodes, top_index + 1, hi, black_height - 1)
+            red.color = False
+            red.left = red_left
+            red.right = red_right
+            red.subtree_size = top_index - lo
+            if red_left is not None:
+                red_left.parent = red
+            if red_right is not None:
+                red_right.parent = red
+            top.left = red
+            left = red
+        top.color = True
+        top.right = right
+        top.subtree_size = n
+        if left is not None:
+            left.parent = top
+        if right is not None:
+            right.parent = top
+        return top
+
+    def split(self, key):
+        """
+        Splits the tree in O(log n): this tree keeps the keys less than key and the keys from key up are
+        moved into a new tree, which is returned
+        :param key: the first key of the returned tree (it does not have to be present)
+        """
+        self.compact()
+        left, left_height, match, right, right_height = self.__split_nodes(self.root, self.__black_height(self.root),
+                                                                           key)
+        if match is not None:
+            right, right_height = self.__join_nodes(None, 0, match, right, right_height)
+        other = self.__empty_like()
+        self.__adopt(left)
+        other.__adopt(right)
+        return other
+
+    def join(self, other):
+        """
+        Appends all entries of other to this tree in O(log n), leaving other empty
+        Every key of other has to be greater than every key of this tree and both trees must have been created with
+        the same options, otherwise ValueError is raised
+        Can also be called as RedBlackTree.join(left, right)
+        :param other: the tree holding the larger keys
+        """
+        if other is self:
+            return
+        self.__check_compatible(other)
+        if other.root is None:
+            return
+        self.compact()
+        other.compact()
+        if self.root is not None and not self.__max(self.root).key < other.__min(other.root).key:
+            raise ValueError("join() requires every key of the other tree to be greater than every key of this one")
+        top, height = self.__join_pieces(self.root, self.__black_height(self.root),
+                                         other.root, other.__black_height(other.root))
+        self.__adopt(top)
+        other.__adopt(None)
+
+    def delete_range(self, lo=None, hi=None, inclusive=(True, True)):
+        """
+        Removes every key between lo and hi with a few splits and joins instead of one delete per key
+        Returns the number of removed entries
+        :param lo: the lower bound, or None for no lower bound
+        :param hi: the upper bound, or None for no upper bound
+        :param inclusive: pair of booleans saying whether lo and hi themselves are removed
+        """
+        middle = self.__cut_range(lo, hi, inclusive)
+        return 0 if middle is None else middle.subtree_size
+
+    def pop_range(self, lo=None, hi=None, inclusive=(True, True)):
+        """
+        Removes every key between lo and hi and returns the removed (key, value) pairs in ascending key order
+        :param lo: the lower bound, or None for no lower bound
+        :param hi: the upper bound, or None for no upper bound
+        :param inclusive: pair of booleans saying whether lo and hi themselves are removed
+        """
+        return [(node.key, node.value) for node in self.__subtree_nodes(self.__cut_range(lo, hi, inclusive))]
+
+    def union(self, other):
+        """
+        Merges all entries of other into this tree in O(m log(n/m + 1)), m being the size of the smaller tree
+        For keys present in both trees the value from other wins. other is left empty
+        Like join and the other set operations, raises ValueError if other was created with different options
+        :param other: the tree to merge in
+        """
+        if other is self:
+            return
+        self.__check_compatible(other)
+        self.compact()
+        other.compact()
+        top, height = self.__union_pieces(self.root, self.__black_height(self.root),
+                                          other.root, other.__black_height(other.root), True)
+        self.__adopt(top)
+        other.__adopt(None)
+
+    def intersection(self, other):
+        """
+        Keeps only the keys that are also present in other, in O(m log(n/m + 1)), m being the size of the smaller tree
+        Values stay the ones from this tree. other is consumed by the operation and left empty
+        :param other: the tree whose keys are kept
+        """
+        if other is self:
+            return
+        self.__check_compatible(other)
+        self.compact()
+        other.compact()
+        top, height = self.__intersect_pieces(self.root, self.__black_height(self.root),
+                                              other.root, other.__black_height(other.root), False)
+        self.__adopt(top)
+        other.__adopt(None)
+
+    def difference(self, other):
+        """
+        Removes every key that is present in other, in O(m log(n/m + 1)), m being the size of the smaller tree
+        other is consumed by the operation and left empty
+        :param other: the tree whose keys are removed
+        """
+        if other is self:
+            self.__adopt(None)
+            return
+        self.__check_compatible(other)
+        self.compact()
+        other.compact()
+        top, height = self.__subtract_pieces(self.root, self.__black_height(self.root),
+                                             other.root, other.__black_height(other.root))
+        self.__adopt(top)
+        other.__adopt(None)
+
+    #The helpers below work on standalone pieces: detached subtrees with a black top and no parent, passed
+    #around together with their black height so it never has to be recomputed while splitting and joining.
+    #Pieces never hold tombstones, the public operations compact before they cut a tree into pieces
+
+    def __empty_like(self):
+        # A new empty tree with the same options as this one
+        return type(self)(**self.__options())
+
+    def __options(self):
+        # The constructor options this tree was created with
+        return {"index_values": self.value_index is not None, "aggregate": self.aggregate_ops,
+                "key_dtype": self.key_dtype, "lazy_delete": self.lazy_delete}
+
+    def __check_compatible(self, other):
+        # Nodes of other are linked in as they are, so its aggregates, indexed values and key types have to be the
+        # ones this tree keeps. Raises ValueError before anything is detached when the options differ
+        if self.__options() != other.__options():
+            raise ValueError("both trees must be created with the same options")
+
+    def __adopt(self, top):
+        # Makes a standalone piece the whole content of this tree
+        self.root = top
+        self.__refresh_extremes()
+        self.__numeric_snapshot = None
+        if self.front_cache is not None:
+            self.front_cache.clear()
+        self.total_size = 0 if top is None else top.subtree_size
+        if self.value_index is not None:
+            self.__rebuild_value_index()
+        if self.journal is not None:
+            #whole subtrees moved in or out, which is cheaper to record as a fresh snapshot than entry by entry
+            self.journal.compact()
+
+    def __refresh_extremes(self):
+        # Finds the smallest and largest nodes again after the tree was rebuilt or restructured in bulk
+        if self.root is None:
+            self.__first = self.__last = None
+        else:
+            self.__first = self.__min(self.root)
+            self.__last = self.__max(self.root)
+
+    def __black_height(self, node):
+        # Number of black nodes on every path from node down to an empty link
+        height = 0
+        while node is not None:
+            if node.color:
+                height += 1
+            node = node.left
+        return height
+
+    def __detach_subtree(self, node, height):
+        # Cuts a child subtree loose as a standalone piece. height is the black height the subtree had in place,
+        # which grows by one when a red top has to be recolored
+        if node is None:
+            return None, 0
+        node.parent = None
+        if not node.color:
+            node.color = True
+            height += 1
+        return node, height
+
+    def __subtree_nodes(self, top):
+        # Generator over the nodes of a subtree in ascending key order, using an explicit stack
+        stack = []
+        node = top
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node
+            node = node.right
+
+    def __join_nodes(self, left, left_height, mid, right, right_height):
+        # Joins two pieces around a middle node with every key of left < mid.key < every key of right.
+        # The taller piece is walked down its inner spine to the black height of the shorter one, the middle node
+        # is hung there as a red link and the insertion fix-up runs back up, which costs O(|height difference|)
+        mid.parent = None
+        if left_height == right_height:
+            mid.color = True
+            mid.left = left
+            mid.right = right
+            if left is not None:
+                left.parent = mid
+            if right is not None:
+                right.parent = mid
+            self.__update_subtree_size(mid)
+            return mid, left_height + 1
+
+        mid.color = False
+        if left_height > right_height:
+            parent = None
+            node = left
+            height = left_height
+            while not (height == right_height and (node is None or node.color)):
+                if node.color:
+                    height -= 1
+                parent = node
+                node = node.right
+            mid.left = node
+            mid.right = right
+            parent.right = mid
+            top_height = left_height
+        else:
+            parent = None
+            node = right
+            height = right_height
+            while not (height == left_height and (node is None or node.color)):
+                if node.color:
+                    height -= 1
+                parent = node
+                node = node.left
+            mid.left = left
+            mid.right = node
+            parent.left = mid
+            top_height = right_height
+        mid.parent = parent
+        if mid.left is not None:
+            mid.left.parent = mid
+        if mid.right is not None:
+            mid.right.parent = mid
+        self.__update_subtree_size(mid)
+        top = self.__rebalance_upward(parent)
+        if not top.color:
+            top.color = True
+            top_height += 1
+        return top, top_height
+
+    def __join_pieces(self, left, left_height, right, right_height):
+        # Joins two pieces with every key of left < every key of right, using the minimum of right as the middle
+        if right is None:
+            return left, left_height
+        if left is None:
+            return right, right_height
+        mid, right = self.__detach_min(right)
+        return self.__join_nodes(left, left_height, mid, right, self.__black_height(right))
+
+    def __detach_min(self, top):
+        # Removes the minimal node from a piece, returning it and the remaining piece
+        if not self.__is_red(top.left) and not self.__is_red(top.right):
+            top.color = False
+        node, fix_from = self.__delete_min(top)
+        rest = self.__rebalance_upward(fix_from)
+        if rest is not None:
+            rest.color = True
+        return node, rest
+
+    def __detach_max(self, top):
+        # Removes the maximal node from a piece, returning it and the remaining piece
+        if not self.__is_red(top.left) and not self.__is_red(top.right):
+            top.color = False
+        node, fix_from = self.__delete_max(top)
+        rest = self.__rebalance_upward(fix_from)
+        if rest is not None:
+            rest.color = True
+        return node, rest
+
+    def __split_nodes(self, node, height, key):
+        # Splits a piece into the keys below key and the keys above it. Walks down once, then joins the cut-off
+        # subtrees back together from the bottom up; the heights telescope, so the whole split is O(log n).
+        # Returns (left, left height, node holding key or None, right, right height)
+        path = []
+        match = None
+        while node is not None:
+            child_height = height - 1 if node.color else height
+            node_key = node.key
+            if key < node_key:
+                path.append((node, True, child_height))
+                node = node.left
+            elif node_key < key:
+                path.append((node, False, child_height))
+                node = node.right
+            else:
+                match = node
+                break
+            height = child_height
+        if self.instrumentation is not None:
+            self.instrumentation.record_search(len(path) + (match is not None),
+                                               sum(1 if went_left else 2 for node, went_left, h in path)
+                                               + 2 * (match is not None))
+
+        if match is not None:
+            left, left_height = self.__detach_subtree(match.left, child_height)
+            right, right_height = self.__detach_subtree(match.right, child_height)
+            match.left = match.right = match.parent = None
+            self.__update_subtree_size(match)
+        else:
+            left, left_height, right, right_height = None, 0, None, 0
+        for node, went_left, child_height in reversed(path):
+            if went_left:
+                other, other_height = self.__detach_subtree(node.right, child_height)
+                right, right_height = self.__join_nodes(right, right_height, node, other, other_height)
+            else:
+                other, other_height = self.__detach_subtree(node.left, child_height)
+                left, left_height = self.__join_nodes(other, other_height, node, left, left_height)
+        return left, left_height, match, right, right_height
+
+    def __cut_range(self, lo, hi, inclusive):
+        # Detaches the keys between lo and hi from the tree and returns them as a piece (None when empty)
+        lo_inclusive, hi_inclusive = inclusive
+        if self.root is None or (lo is not None and hi is not None and hi < lo):
+            return None
+        #bounds that cannot be compared with the keys fail here, before anything is logged or cut
+        probe = self.root.key
+        if lo is not None:
+            lo < probe
+        if hi is not None:
+            hi < probe
+        self.compact()
+        if self.journal is not None:
+            self.journal.record_delete_range(lo, hi, inclusive)
+        if self.front_cache is not None:
+            self.front_cache.clear()
+        self.__numeric_snapshot = None
+        rest, rest_height = self.root, self.__black_height(self.root)
+        left, left_height = None, 0
+        if lo is not None:
+            left, left_height, match, rest, rest_height = self.__split_nodes(rest, rest_height, lo)
+            if match is not None:
+                if lo_inclusive:
+                    rest, rest_height = self.__join_nodes(None, 0, match, rest, rest_height)
+                else:
+                    left, left_height = self.__join_nodes(left, left_height, match, None, 0)
+        right, right_height = None, 0
+        if hi is not None:
+            rest, rest_height, match, right, right_height = self.__split_nodes(rest, rest_height, hi)
+            if match is not None:
+                if hi_inclusive:
+                    rest, rest_height = self.__join_nodes(rest, rest_height, match, None, 0)
+                else:
+                    right, right_height = self.__join_nodes(None, 0, match, right, right_height)
+        top, height = self.__join_pieces(left, left_height, right, right_height)
+        self.root = top
+        self.__refresh_extremes()
+        self.total_size = 0 if top is None else top.subtree_size
+        if self.value_index is not None:
+            for node in self.__subtree_nodes(rest):
+                self.__index_remove(node.key, node.value)
+        return rest
+
+    def __union_pieces(self, a, a_height, b, b_height, b_wins):
+        # Union of two pieces: the larger one is split by the root of the smaller one and the halves are merged
+        # recursively, so the recursion follows the smaller piece. b_wins picks whose node survives on equal keys
+        if a is None:
+            return b, b_height
+        if b is None:
+            return a, a_height
+        if a.subtree_size < b.subtree_size:
+            a, a_height, b, b_height = b, b_height, a, a_height
+            b_wins = not b_wins
+        b_left, b_left_height = self.__detach_subtree(b.left, b_height - 1)
+        b_right, b_right_height = self.__detach_subtree(b.right, b_height - 1)
+        a_left, a_left_height, match, a_right, a_right_height = self.__split_nodes(a, a_height, b.key)
+        left, left_height = self.__union_pieces(a_left, a_left_height, b_left, b_left_height, b_wins)
+        right, right_height = self.__union_pieces(a_right, a_right_height, b_right, b_right_height, b_wins)
+        mid = b if match is None or b_wins else match
+        return self.__join_nodes(left, left_height, mid, right, right_height)
+
+    def __intersect_pieces(self, a, a_height, b, b_height, b_wins):
+        # Intersection of two pieces, following the same recursion as __union_pieces
+        if a is None or b is None:
+            return None, 0
+        if a.subtree_size < b.subtree_size:
+            a, a_height, b, b_height = b, b_height, a, a_height
+            b_wins = not b_wins
+        b_left, b_left_height = self.__detach_subtree(b.left, b_height - 1)
+        b_right, b_right_height = self.__detach_subtree(b.right, b_height - 1)
+        a_left, a_left_height, match, a_right, a_right_height = self.__split_nodes(a, a_height, b.key)
+        left, left_height = self.__intersect_pieces(a_left, a_left_height, b_left, b_left_height, b_wins)
+        right, right_height = self.__intersect_pieces(a_right, a_right_height, b_right, b_right_height, b_wins)
+        if match is None:
+            return self.__join_pieces(left, left_height, right, right_height)
+        return self.__join_nodes(left, left_height, b if b_wins else match, right, right_height)
+
+    def __subtract_pieces(self, a, a_height, b, b_height):
+        # Keys of piece a that are not in piece b, recursing over the roots of whichever piece is smaller
+        if a is None:
+            return None, 0
+        if b is None:
+            return a, a_height
+        if b.subtree_size <= a.subtree_size:
+            b_left, b_left_height = self.__detach_subtree(b.left, b_height - 1)
+            b_right, b_right_height = self.__detach_subtree(b.right, b_height - 1)
+            a_left, a_left_height, match, a_right, a_right_height = self.__split_nodes(a, a_height, b.key)
+            left, left_height = self.__subtract_pieces(a_left, a_left_height, b_left, b_left_height)
+            right, right_height = self.__subtract_pieces(a_right, a_right_height, b_right, b_right_height)
+            return self.__join_pieces(left, left_height, right, right_height)
+        a_left, a_left_height = self.__detach_subtree(a.left, a_height - 1)
+        a_right, a_right_height = self.__detach_subtree(a.right, a_height - 1)
+        b_left, b_left_height, match, b_right, b_right_height = self.__split_nodes(b, b_height, a.key)
+        left, left_height = self.__subtract_pieces(a_left, a_left_height, b_left, b_left_height)
+        right, right_height = self.__subtract_pieces(a_right, a_right_height, b_right, b_right_height)
+        if match is not None:
+            return self.__join_pieces(left, left_height, right, right_height)
+        return self.__join_nodes(left, left_height, a, right, right_height)
+
+    def __is_red(self, node):
+        # Helper method that checks if a node is red
+        if node is None:
+            return False
+        return not node.color
+
+    def __rotate_left(self, node):
+        #Left rotation in a Red-Black Tree. Used to balance the tree after an insertion or as part of other tree operations.
+        #The right child takes node's place under node's parent, so the parent links are patched here as well.
+        #The root pointer is left to the caller, which sets it once the walk reaches the top of the tree
+        x = node.right
+        child = x.left
+        node.right = child
+        if child is not None:
+            child.parent = node
+        parent = node.parent
+        x.parent = parent
+        if parent is not None:
+            if parent.left is node:
+                parent.left = x
+            else:
+                parent.right = x
+        x.left = node
+        node.parent = x
+        x.color = node.color
+        node.color = False
+        #x now spans exactly what node spanned before the rotation
+        x.subtree_size = node.subtree_size
+        x.aggregate = node.aggregate
+        self.__update_subtree_size(node)
+        return x
+
+    def __rotate_right(self, node):
+        # Right rotation in a Red-Black Tree. Mirror image of __rotate_left
+        x = node.left
+        child = x.right
+        node.left = child
+        if child is not None:
+            child.parent = node
+        parent = node.parent
+        x.parent = parent
+        if parent is not None:
+            if parent.left is node:
+                parent.left = x
+            else:
+                parent.right = x
+        x.right = node
+        node.parent = x
+        x.color = node.color
+        node.color = False
+        x.subtree_size = node.subtree_size
+        x.aggregate = node.aggregate
+        self.__update_subtree_size(node)
+        return x
+
+    def __flip_colors(self, node):
+        """
+        Flips the colors of a "family" of nodes, maintaining black balance
+        :param node: The parent node of the "family"
+        """
+        node.color = not node.color
+        node.left.color = not node.left.color
+        node.right.color = not node.right.color
+
+    def get(self, key):
+        """
+        Returns the value corresponding to the given key, or None if the key is not present
+        :param key: the key to be searched for
+        """
+        if self.front_cache is not None:
+            node = self.front_cache.lookup(key)
+            return None if node is None else node.value
+        if self.instrumentation is not None:
+            node = self.__find_node(key)
+            return None if node is None else node.value
+        node = self.root
+        while node is not None:
+            node_key = node.key
+            #go left or right until we find the right key or fall off the tree
+            if key < node_key:
+                node = node.left
+            elif node_key < key:
+                node = node.right
+            else:
+                value = node.value
+                return None if value is _TOMBSTONE else value
+        return None
+
+    def get_many(self, keys, default=None):
+        """
+        Returns the values for a batch of keys, in the order the keys were given
+        The batch is sorted and resolved in one merged descent, so a node shared by several lookups is visited once
+        In typed key mode a NumPy array of keys is answered with vectorized binary searches instead,
+        returning an object array
+        :param keys: the keys to look up
+        :param default: the value returned for keys that are not present
+        """
+        if self.key_dtype is not None and hasattr(keys, "dtype"):
+            np = RedBlackTree.__numpy()
+            if self.__descend_many(len(keys)):
+                result = np.empty(len(keys), dtype=object)
+                for i, node in enumerate(self.__find_many(np.asarray(keys).tolist())):
+                    result[i] = default if node is None else node.value
+                return result
+            index, found = self.__locate_many(keys)
+            result = np.full(len(found), default, dtype=object)
+            result[found] = self.__numeric_values()[index[found]]
+            return result
+        return [default if node is None else node.value for node in self.__find_many(keys)]
+
+    def contains_many(self, keys):
+        """
+        Returns a list of booleans saying which of a batch of keys are present, in the order the keys were given
+        In typed key mode a NumPy array of keys is answered with vectorized binary searches, returning a bool array
+        :param keys: the keys to look up
+        """
+        if self.key_dtype is not None and hasattr(keys, "dtype"):
+            if self.__descend_many(len(keys)):
+                np = RedBlackTree.__numpy()
+                nodes = self.__find_many(np.asarray(keys).tolist())
+                return np.fromiter((node is not None for node in nodes), dtype=bool, count=len(nodes))
+            return self.__locate_many(keys)[1]
+        return [node is not None for node in self.__find_many(keys)]
+
+    def rank_many(self, keys):
+        """
+        Typed key mode only: returns an array with, for each key, the number of keys in the tree smaller than it
+        Unlike find_rank this also works for keys that are not present
+        :param keys: NumPy array (or sequence) of keys
+        """
+        sorted_keys = self.__numeric_keys()
+        np = RedBlackTree.__numpy()
+        return np.searchsorted(sorted_keys, np.asarray(keys), side="left")
+
+    def count_range(self, lo, hi, inclusive=(True, True)):
+        """
+        Typed key mode only: returns the number of keys between lo and hi. lo and hi may be scalars or NumPy
+        arrays of bounds, in which case an array of counts is returned
+        :param lo: the lower bound(s)
+        :param hi: the upper bound(s)
+        :param inclusive: pair of booleans saying whether lo and hi themselves are counted
+        """
+        sorted_keys = self.__numeric_keys()
+        np = RedBlackTree.__numpy()
+        lo_inclusive, hi_inclusive = inclusive
+        start = np.searchsorted(sorted_keys, np.asarray(lo), side="left" if lo_inclusive else "right")
+        end = np.searchsorted(sorted_keys, np.asarray(hi), side="right" if hi_inclusive else "left")
+        return np.maximum(end - start, 0)
+
+    def __locate_many(self, keys):
+        # Vectorized lookup for typed key mode: returns (buffer index of each key, mask of the keys present)
+        np = RedBlackTree.__numpy()
+        sorted_keys = self.__numeric_keys()
+        keys = np.asarray(keys)
+        n = len(sorted_keys)
+        if n == 0:
+            return np.zeros(len(keys), dtype=np.intp), np.zeros(len(keys), dtype=bool)
+        index = np.minimum(np.searchsorted(sorted_keys, keys, side="left"), n - 1)
+        return index, sorted_keys[index] == keys
+
+    def __descend_many(self, count):
+        # True when a batch of count lookups is cheaper as tree descents than as a rebuild of the stale key buffer:
+        # the descents visit about count * log n nodes, the rebuild all n of them
+        n = self.total_size
+        return self.__numeric_snapshot is None and count * n.bit_length() < n
+
+    def __numeric_keys(self):
+        # The sorted key buffer of typed key mode, rebuilt in O(n) by the first vectorized query after a write
+        if self.key_dtype is None:
+            raise ValueError("vectorized queries need a tree created with key_dtype")
+        if self.__numeric_snapshot is None:
+            np = RedBlackTree.__numpy()
+            #[keys, values]: the values are only built when get_many needs them
+            self.__numeric_snapshot = [np.fromiter(iter(self), dtype=self.key_dtype, count=self.total_size), None]
+        return self.__numeric_snapshot[0]
+
+    def __numeric_values(self):
+        # The value array matching the key buffer, built on the first get_many after a write
+        self.__numeric_keys()
+        snapshot = self.__numeric_snapshot
+        if snapshot[1] is None:
+            np = RedBlackTree.__numpy()
+            values = np.empty(self.total_size, dtype=object)
+            #filled one by one so sequence values are stored as objects instead of being broadcast
+            for i, value in enumerate(self.values()):
+                values[i] = value
+            snapshot[1] = values
+        return snapshot[1]
+
+    def __typed_key(self, key):
+        # Typed key mode: the key as a plain Python number, refused with ValueError when the dtype cannot hold it
+        # exactly, so a key that would be truncated, wrapped or overflowed fails at write time and not in a later query
+        cast = self.__key_cast
+        try:
+            typed = cast(key)
+        except (TypeError, ValueError, OverflowError):
+            raise ValueError("key %r cannot be stored as %s" % (key, self.key_dtype.name)) from None
+        lo, hi = self.__key_range
+        if typed != key or not (lo <= typed <= hi or (cast is float and typed in (float("inf"), float("-inf")))):
+            raise ValueError("key %r cannot be stored exactly as %s" % (key, self.key_dtype.name))
+        return typed
+
+    @staticmethod
+    def __numpy():
+        # NumPy is only needed for typed key mode, so it is imported on first use
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError("typed key mode (key_dtype) requires NumPy") from None
+        return numpy
+
+    def __find_many(self, keys):
+        # Resolves a batch of keys to their nodes (None when absent). The sorted batch is partitioned at every node
+        # with a binary search, and only the slices that are not empty continue into the children
+        keys = list(keys)
+        nodes = [None] * len(keys)
+        if self.root is None or not keys:
+            return nodes
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        sorted_keys = [keys[i] for i in order]
+        stack = [(self.root, 0, len(keys))]
+        instrumentation = self.instrumentation
+        while stack:
+            node, lo, hi = stack.pop()
+            if hi - lo == 1:
+                #a single key left for this subtree, finish it with a plain descent
+                key = sorted_keys[lo]
+                while node is not None:
+                    if instrumentation is not None:
+                        instrumentation.record_search(1, 1 if key < node.key else 2)
+                    node_key = node.key
+                    if key < node_key:
+                        node = node.left
+                    elif node_key < key:
+                        node = node.right
+                    else:
+                        nodes[order[lo]] = node
+                        break
+                continue
+            node_key = node.key
+            mid = bisect.bisect_left(sorted_keys, node_key, lo, hi)
+            end = mid
+            while end < hi and not node_key < sorted_keys[end]:
+                nodes[order[end]] = node
+                end += 1
+            if instrumentation is not None:
+                instrumentation.record_search(1, end - mid + (end < hi))
+            if lo < mid and node.left is not None:
+                stack.append((node.left, lo, mid))
+            if end < hi and node.right is not None:
+                stack.append((node.right, end, hi))
+        if self.tombstones:
+            nodes = [None if node is not None and node.value is _TOMBSTONE else node for node in nodes]
+        return nodes
+
+    def delete(self, key):
+        """
+        Removes a key-value pair, returning the deleted value
+        Returns None if the key wasn't present
+        :param key: the key to be deleted
+        """
+        target = self.__find_node(key)
+        if target is None:
+            return None
+        if self.lazy_delete is not None:
+            return self.__bury(target)
+        value = target.value
+        self.__before_remove(target)
+
+        node = self.root
+        if not self.__is_red(node.left) and not self.__is_red(node.right):
+            node.color = False  # Set the root node color to red so there is a red link to push down
+
+        #Top-down pass: push a red link down the search path so the node that is removed is never a 2-node
+        instrumentation = self.instrumentation
+        while True:
+            if instrumentation is not None:
+                instrumentation.record_search(1, 1)
+            if key < node.key:
+                left = node.left
+                if left.color and not self.__is_red(left.left):
+                    node = self.__move_red_left(node)
+                node = node.left
+                continue
+            if self.__is_red(node.left):
+                node = self.__rotate_right(node)
+            if node is target and node.right is None:
+                fix_from = self.__detach_leaf(node)
+                break
+            right = node.right
+            if right.color and not self.__is_red(right.left):
+                node = self.__move_red_right(node)
+            if node is target:
+                #Splice the successor into the target's place instead of copying its key and value,
+                #so nodes never change identity under the caller
+                successor, fix_from = self.__delete_min(node.right)
+                self.__replace_node(node, successor)
+                if fix_from is node:
+                    fix_from = successor
+                break
+            node = node.right
+
+        self.total_size -= 1
+        self.root = self.__rebalance_upward(fix_from)
+        if self.root is not None:
+            self.root.color = True  # Ensure the root is black after deletion
+        return value
+
+    def __find_node(self, key):
+        # Helper method that returns the node holding key, or None if the key is not present (or a tombstone)
+        if self.instrumentation is not None:
+            return self.__counted_find_node(key)
+        node = self.root
+        while node is not None:
+            node_key = node.key
+            if key < node_key:
+                node = node.left
+            elif node_key < key:
+                node = node.right
+            else:
+                return None if node.value is _TOMBSTONE else node
+        return None
+
+    def __counted_find_node(self, key):
+        # __find_node while instrumentation is on, counting the nodes and key comparisons of the descent
+        node = self.root
+        nodes = 0
+        comparisons = 0
+        while node is not None:
+            nodes += 1
+            node_key = node.key
+            comparisons += 1
+            if key < node_key:
+                node = node.left
+                continue
+            comparisons += 1
+            if node_key < key:
+                node = node.right
+            else:
+                break
+        self.instrumentation.record_search(nodes, comparisons)
+        return None if node is None or node.value is _TOMBSTONE else node
+
+    def __record_path(self, node, comparisons):
+        # Instrumentation: charges a descent from the root that ended on node after the given number of key
+        # comparisons there. The rest of the path is read back along the parent links: the descent made one
+        # comparison at every node it left to the left and two at every node it left to the right
+        nodes = 1
+        parent = node.parent
+        while parent is not None:
+            nodes += 1
+            comparisons += 1 if parent.left is node else 2
+            node = parent
+            parent = node.parent
+        self.instrumentation.record_search(nodes, comparisons)
+
+    def __bury(self, node):
+        # Lazy delete mode: turns a live node into a tombstone without any restructuring, only uncounting it on the
+        # path up to the root, and compacts once the tombstones pass the lazy_delete fraction. Returns the value
+        value = node.value
+        self.__before_remove(node)
+        node.value = _TOMBSTONE
+        self.total_size -= 1
+        self.tombstones += 1
+        while node is not None:
+            self.__update_subtree_size(node)
+            node = node.parent
+        if self.tombstones > self.lazy_delete * (self.total_size + self.tombstones):
+            self.compact()
+        return value
+
+    def __revive(self, node, value):
+        # Gives a tombstone node a value again and counts it as live on the path up to the root
+        node.value = value
+        self.total_size += 1
+        self.tombstones -= 1
+        self.__numeric_snapshot = None
+        if self.front_cache is not None:
+            self.front_cache.discard(node.key)
+        if self.value_index is not None:
+            self.__index_add(node.key, value)
+        if self.__first is None or node.key < self.__first.key:
+            self.__first = node
+        if self.__last is None or self.__last.key < node.key:
+            self.__last = node
+        while node is not None:
+            self.__update_subtree_size(node)
+            node = node.parent
+
+    def compact(self):
+        """
+        Rebuilds the tree from its live entries in O(n), removing the tombstones left by lazy delete mode
+        Runs by itself once the tombstones pass the lazy_delete fraction, and before split, join, the range deletes
+        and the set operations, which cut the tree into whole subtrees. Returns the number of tombstones removed
+        """
+        removed = self.tombstones
+        if removed:
+            self.__link_sorted_nodes(list(self.__in_order_nodes()))
+        return removed
+
+    def pop_min(self):
+        """
+        Removes the entry with the smallest key and returns it as a (key, value) pair, or None when the tree is empty
+        The node is known from the cached minimum, so this is a single top-down pass down the left spine
+        """
+        node = self.__first
+        if node is None:
+            return None
+        if self.lazy_delete is not None:
+            return node.key, self.__bury(node)
+        self.__before_remove(node)
+        node, self.root = self.__detach_min(self.root)
+        self.total_size -= 1
+        return node.key, node.value
+
+    def pop_max(self):
+        """
+        Removes the entry with the largest key and returns it as a (key, value) pair, or None when the tree is empty
+        The node is known from the cached maximum, so this is a single top-down pass down the right spine
+        """
+        node = self.__last
+        if node is None:
+            return None
+        if self.lazy_delete is not None:
+            return node.key, self.__bury(node)
+        self.__before_remove(node)
+        node, self.root = self.__detach_max(self.root)
+        self.total_size -= 1
+        return node.key, node.value
+
+    def __before_remove(self, node):
+        # Bookkeeping for a node that is about to be removed: the journal, the value index, the numeric key
+        # buffer and the cached extremes, which move to the neighbouring node while the links are still intact
+        if self.journal is not None:
+            self.journal.record_delete(node.key)
+        if self.value_index is not None:
+            self.__index_remove(node.key, node.value)
+        if self.front_cache is not None:
+            self.front_cache.discard(node.key)
+        self.__numeric_snapshot = None
+        if node is self.__first:
+            self.__first = self.__next_live(node)
+        if node is self.__last:
+            self.__last = self.__prev_live(node)
+
+    def __delete_min(self, node):
+        # Top-down removal of the minimal node in the subtree rooted at the given node.
+        # Returns the detached node and the node the upward rebalance has to start from
+        instrumentation = self.instrumentation
+        while node.left is not None:
+            if instrumentation is not None:
+                instrumentation.record_search(1, 0)
+            left = node.left
+            if left.color and not self.__is_red(left.left):
+                node = self.__move_red_left(node)
+            node = node.left
+        if instrumentation is not None:
+            instrumentation.record_search(1, 0)
+        return node, self.__detach_leaf(node)
+
+    def __delete_max(self, node):
+        # Mirror of __delete_min: top-down removal of the maximal node in the subtree rooted at the given node.
+        # Left leaning red links are turned right first so the right spine is never a 2-node when it is entered
+        instrumentation = self.instrumentation
+        while True:
+            if instrumentation is not None:
+                instrumentation.record_search(1, 0)
+            if self.__is_red(node.left):
+                node = self.__rotate_right(node)
+            right = node.right
+            if right is None:
+                break
+            if right.color and not self.__is_red(right.left):
+                node = self.__move_red_right(node)
+            node = node.right
+        return node, self.__detach_leaf(node)
+
+    def __detach_leaf(self, node):
+        # Unhooks a leaf from its parent and returns the parent (None when the leaf was the root)
+        parent = node.parent
+        if parent is not None:
+            if parent.left is node:
+                parent.left = None
+            else:
+                parent.right = None
+            node.parent = None
+        return parent
+
+    def __replace_node(self, node, replacement):
+        # Puts a detached node into the position of node, taking over its links, color and size
+        replacement.color = node.color
+        replacement.subtree_size = node.subtree_size
+        replacement.left = node.left
+        if replacement.left is not None:
+            replacement.left.parent = replacement
+        replacement.right = node.right
+        if replacement.right is not None:
+            replacement.right.parent = replacement
+        parent = node.parent
+        replacement.parent = parent
+        if parent is not None:
+            if parent.left is node:
+                parent.left = replacement
+            else:
+                parent.right = replacement
+        node.left = node.right = node.parent = None
+
+    def __rebalance_upward(self, node):
+        # Walk from the lowest touched node up to the top of its tree, fixing sizes and colors on the way.
+        # Returns the top node, which the caller makes the root (or None if node was None)
+        top = None
+        while node is not None:
+            self.__update_subtree_size(node)
+            top = self.__fix_up(node)
+            node = top.parent
+        return top
+
+    def __move_red_left(self, node):
+        # Move a red node from the left to the right
+        self.__flip_colors(node)
+        if self.__is_red(node.right.left):
+            self.__rotate_right(node.right)
+            node = self.__rotate_left(node)
+            self.__flip_colors(node)
+        return node
+
+    def __move_red_right(self, node):
+        # Move a red node from the right to the left
+        self.__flip_colors(node)
+        if self.__is_red(node.left.left):
+            node = self.__rotate_right(node)
+            self.__flip_colors(node)
+        return node
+
+    def __fix_up(self, node):
+        # Restores the left leaning red black properties at a single node on the way back up from a deletion
+        if self.__is_red(node.right) and not self.__is_red(node.left):
+            node = self.__rotate_left(node)
+        if self.__is_red(node.left) and self.__is_red(node.left.left):
+            node = self.__rotate_right(node)
+        if self.__is_red(node.left) and self.__is_red(node.right):
+            self.__flip_colors(node)
+        return node
+
+    def __min(self, node):
+        # Helper method to find the minimal key in a subtree
+        while node.left is not None:
+            node = node.left
+        return node
+
+    def __next_node(self, node):
+        # Helper method that returns the in-order successor of a node by following the parent links
+        if node.right is not None:
+            node = node.right
+            while node.left is not None:
+                node = node.left
+            return node
+        parent = node.parent
+        while parent is not None and parent.right is node:
+            node = parent
+            parent = node.parent
+        return parent
+
+    def __next_live(self, node):
+        # The in-order successor of a node, stepping over tombstones
+        node = self.__next_node(node)
+        while node is not None and node.value is _TOMBSTONE:
+            node = self.__next_node(node)
+        return node
+
+    def __prev_live(self, node):
+        # The in-order predecessor of a node, stepping over tombstones
+        node = self.__prev_node(node)
+        while node is not None and node.value is _TOMBSTONE:
+            node = self.__prev_node(node)
+        return node
+
+    def __in_order_nodes(self):
+        # Iterator over the nodes in ascending key order, the tree must not change while it runs
+        return self.__irange_nodes(None, None, (True, True), False)
+
+    def __max(self, node):
+        # Helper method to find the maximal key in a subtree
+        while node.right is not None:
+            node = node.right
+        return node
+
+    def __prev_node(self, node):
+        # Helper method that returns the in-order predecessor of a node by following the parent links
+        if node.left is not None:
+            node = node.left
+            while node.right is not None:
+                node = node.right
+            return node
+        parent = node.parent
+        while parent is not None and parent.left is node:
+            node = parent
+            parent = node.parent
+        return parent
+
+    def __ceiling_node(self, key, inclusive=True):
+        # Helper method that returns the node with the smallest key >= key (> key when not inclusive), or None
+        node = self.root
+        best = None
+        while node is not None:
+            node_key = node.key
+            if key < node_key:
+                best = node
+                node = node.left
+            elif node_key < key:
+                node = node.right
+            elif inclusive:
+                best = node
+                break
+            else:
+                node = node.right
+        if best is not None and best.value is _TOMBSTONE:
+            best = self.__next_live(best)
+        return best
+
+    def __floor_node(self, key, inclusive=True):
+        # Helper method that returns the node with the largest key <= key (< key when not inclusive), or None
+        node = self.root
+        best = None
+        while node is not None:
+            node_key = node.key
+            if node_key < key:
+                best = node
+                node = node.right
+            elif key < node_key:
+                node = node.left
+            elif inclusive:
+                best = node
+                break
+            else:
+                node = node.left
+        if best is not None and best.value is _TOMBSTONE:
+            best = self.__prev_live(best)
+        return best
+
+    def __irange_nodes(self, lo, hi, inclusive, reverse):
+        # Generator over the live nodes with keys between lo and hi, positioned by one descent and then stepped
+        # with the parent links, so each further node costs O(1) amortized
+        lo_inclusive, hi_inclusive = inclusive
+        if self.root is None:
+            return
+        if not reverse:
+            node = self.__first if lo is None else self.__ceiling_node(lo, lo_inclusive)
+            while node is not None:
+                if hi is not None and (hi < node.key or (not hi_inclusive and not node.key < hi)):
+                    return
+                if node.value is not _TOMBSTONE:
+                    yield node
+                #inline successor step
+                if node.right is not None:
+                    node = node.right
+                    while node.left is not None:
+                        node = node.left
+                else:
+                    parent = node.parent
+                    while parent is not None and parent.right is node:
+                        node = parent
+                        parent = node.parent
+                    node = parent
+        else:
+            node = self.__last if hi is None else self.__floor_node(hi, hi_inclusive)
+            while node is not None:
+                if lo is not None and (node.key < lo or (not lo_inclusive and not lo < node.key)):
+                    return
+                if node.value is not _TOMBSTONE:
+                    yield node
+                #inline predecessor step
+                if node.left is not None:
+                    node = node.left
+                    while node.right is not None:
+                        node = node.right
+                else:
+                    parent = node.parent
+                    while parent is not None and parent.left is node:
+                        node = parent
+                        parent = node.parent
+                    node = parent
+
+    def __update_subtree_size(self, node):
+        if node is not None:
+            left = node.left
+            right = node.right
+            #counts live entries, so a tombstone adds nothing
+            node.subtree_size = ((node.value is not _TOMBSTONE) + (0 if left is None else left.subtree_size)
+                                 + (0 if right is None else right.subtree_size))
+            if self.aggregate_ops is not None:
+                self.__update_aggregate(node)
+
+    def __update_aggregate(self, node):
+        # Recombines a node's aggregate from its children's aggregates and its own lifted value, in key order
+        combine, identity, lift = self.aggregate_ops
+        total = identity if node.value is _TOMBSTONE else lift(node.value)
+        if node.left is not None:
+            total = combine(node.left.aggregate, total)
+        if node.right is not None:
+            total = combine(total, node.right.aggregate)
+        node.aggregate = total
+
+    @staticmethod
+    def __lift_value(value):
+        # Default aggregate lift, the value itself is the element
+        return value
+
+    def __post_order_nodes(self, top):
+        # Generator over the nodes of a subtree with children before parents, using an explicit stack
+        stack = []
+        last = None
+        node = top
+        while stack or node is not None:
+            if node is not None:
+                stack.append(node)
+                node = node.left
+                continue
+            peek = stack[-1]
+            if peek.right is not None and last is not peek.right:
+                node = peek.right
+            else:
+                last = stack.pop()
+                yield last
+
+    def __get_subtree_size(self, node):
+        if node is None:
+            return 0
+        return node.subtree_size
+
+
+    def contains_key(self, key):
+        """
+        Returns true if the key is present
+        :param key: the key to be searched for
+        """
+        if self.front_cache is not None:
+            return self.front_cache.lookup(key) is not None
+        if self.instrumentation is not None:
+            return self.__find_node(key) is not None
+        node = self.root
+        while node is not None:
+            node_key = node.key
+            if key < node_key:
+                node = node.left
+            elif node_key < key:
+                node = node.right
+            else:
+                return node.value is not _TOMBSTONE
+        # If we fall off the tree (or it is empty), the key isn't in it
+        return False
+
+    def contains_value(self, value):
+        """
+        Returns true if the value is present
+        O(1) on average with index_values, otherwise a full scan
+        :param value: The value to search for
+        """
+        if self.value_index is not None:
+            try:
+                return value in self.value_index
+            except TypeError:
+                #unhashable values can't have been stored in an indexed tree
+                return False
+        for node in self.__in_order_nodes():
+            if node.value == value:
+                return True
+        return False
+
+    def __index_add(self, key, value):
+        # Records key under value in the reverse index
+        keys = self.value_index.get(value)
+        if keys is None:
+            self.value_index[value] = {key: None}
+        else:
+            keys[key] = None
+
+    def __index_remove(self, key, value):
+        # Drops key from the reverse index entry of value, removing the entry once no key holds the value
+        keys = self.value_index[value]
+        del keys[key]
+        if not keys:
+            del self.value_index[value]
+
+    def __rebuild_value_index(self):
+        # Recomputes the reverse index from scratch, used after the tree has been relinked wholesale
+        self.value_index = {}
+        for node in self.__in_order_nodes():
+            self.__index_add(node.key, node.value)
+
+    def __iter__(self):
+        """
+        Iterates over the keys in ascending order
+        The tree must not be modified while an iterator over it is in use
+        """
+        for node in self.__irange_nodes(None, None, (True, True), False):
+            yield node.key
+
+    def __reversed__(self):
+        """
+        Iterates over the keys in descending order
+        """
+        for node in self.__irange_nodes(None, None, (True, True), True):
+            yield node.key
+
+    def keys(self):
+        """
+        Returns a lazy iterator over the keys in ascending order
+        """
+        return iter(self)
+
+    def values(self):
+        """
+        Returns a lazy iterator over the values in ascending key order
+        """
+        return (node.value for node in self.__irange_nodes(None, None, (True, True), False))
+
+    def items(self):
+        """
+        Returns a lazy iterator over the (key, value) pairs in ascending key order
+        """
+        return ((node.key, node.value) for node in self.__irange_nodes(None, None, (True, True), False))
+
+    def irange(self, lo=None, hi=None, inclusive=(True, True), reverse=False):
+        """
+        Returns a lazy iterator over the keys between lo and hi
+        Starting costs one O(log n) descent, every further key O(1) amortized
+        :param lo: the lower bound, or None for no lower bound
+        :param hi: the upper bound, or None for no upper bound
+        :param inclusive: pair of booleans saying whether lo and hi themselves are included
+        :param reverse: True to iterate from hi down to lo
+        """
+        return (node.key for node in self.__irange_nodes(lo, hi, inclusive, reverse))
+
+    def irange_items(self, lo=None, hi=None, inclusive=(True, True), reverse=False):
+        """
+        Same as irange, but yields (key, value) pairs
+        :param lo: the lower bound, or None for no lower bound
+        :param hi: the upper bound, or None for no upper bound
+        :param inclusive: pair of booleans saying whether lo and hi themselves are included
+        :param reverse: True to iterate from hi down to lo
+        """
+        return ((node.key, node.value) for node in self.__irange_nodes(lo, hi, inclusive, reverse))
+
+    #Public operations wrapped while instrumentation is on
+    __INSTRUMENTED_OPERATIONS = (
+        "put", "get", "delete", "contains_key", "find_rank", "get_many", "contains_many", "rank_many", "count_range",
+        "floor", "ceiling", "lower", "higher", "find_predecessor", "find_successor", "select", "aggregate",
+        "put_many", "delete_range", "pop_range", "split", "join", "union", "intersection", "difference", "pop_min",
+        "pop_max",
+    )
+    #Rebalancing helpers counted while instrumentation is on
+    __INSTRUMENTED_HELPERS = (
+        ("_RedBlackTree__rotate_left", "rotations"), ("_RedBlackTree__rotate_right", "rotations"),
+        ("_RedBlackTree__flip_colors", "color_flips"), ("_RedBlackTree__move_red_left", "move_red_left"),
+        ("_RedBlackTree__move_red_right", "move_red_right"),
+    )
+
+    def enable_front_cache(self, capacity=4096):
+        """
+        Puts a bounded LRU cache of recently looked up keys in front of get and contains_key, returning the
+        FrontCache object with its hit and miss counters. Writes keep it coherent, ordered operations bypass it
+        :param capacity: the most keys kept
+        """
+        if self.front_cache is None:
+            self.front_cache = self.FrontCache(capacity, self.__find_node)
+        return self.front_cache
+
+    def disable_front_cache(self):
+        """
+        Removes the front cache, returning the FrontCache object with the final counters
+        """
+        front_cache = self.front_cache
+        self.front_cache = None
+        return front_cache
+
+    def enable_instrumentation(self):
+        """
+        Starts collecting per-operation counters and latency histograms, returning the Instrumentation object
+        The counting wrappers are installed on this instance only, so a tree without instrumentation runs the
+        plain methods and pays nothing for the feature
+        """
+        if self.instrumentation is not None:
+            return self.instrumentation
+        instrumentation = self.Instrumentation()
+        self.instrumentation = instrumentation
+        for name in self.__INSTRUMENTED_OPERATIONS:
+            setattr(self, name, self.__instrumented_operation(instrumentation, name, getattr(self, name)))
+        for name, counter in self.__INSTRUMENTED_HELPERS:
+            setattr(self, name, self.__counted_helper(instrumentation, counter, getattr(self, name)))
+        return instrumentation
+
+    def disable_instrumentation(self):
+        """
+        Stops collecting and removes the counting wrappers, returning the Instrumentation object with the results
+        """
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            return None
+        for name in self.__INSTRUMENTED_OPERATIONS:
+            delattr(self, name)
+        for name, counter in self.__INSTRUMENTED_HELPERS:
+            delattr(self, name)
+        self.instrumentation = None
+        return instrumentation
+
+    def __instrumented_operation(self, instrumentation, name, method):
+        # Wraps a public operation to count the call and its latency, and to charge the work it does to it
+        clock = time.perf_counter_ns
+
+        def wrapper(*args, **kwargs):
+            if instrumentation.current is not None:
+                #called from inside another operation, whose call and latency already cover this one
+                return method(*args, **kwargs)
+            instrumentation.counts(name)["calls"] += 1
+            instrumentation.current = name
+            start = clock()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                instrumentation.record_latency(name, clock() - start)
+                instrumentation.current = None
+        wrapper.__name__ = name
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+
+    def __counted_helper(self, instrumentation, counter, method):
+        # Wraps a rebalancing helper to charge each call to the operation that is running
+        def wrapper(*args):
+            instrumentation.counts(instrumentation.current or "other")[counter] += 1
+            return method(*args)
+        return wrapper
+
+    def is_empty(self):
+        """
+        Returns true if the tree is empty
+        """
+        return self.total_size == 0
+
+    def size(self):
+        """
+        Returns the number of key-value pairs in the tree
+        """
+        return self.total_size
+
+    def reverse_lookup(self, value):
+        """
+        Finds a key that maps to the value within the red black tree, Returns None if there is none
+        With index_values this is the key that has held the value the longest, found in O(1) on average;
+        otherwise it is the smallest such key, found with a scan
+        :param value: the value to search for
+        """
+        if self.value_index is not None:
+            try:
+                keys = self.value_index.get(value)
+            except TypeError:
+                return None
+            if keys is None:
+                return None
+            return next(iter(keys))
+        for node in self.__in_order_nodes():
+            if node.value == value:
+                return node.key
+        return None
+
+    def find_first_key(self):
+        """
+        Returns the key that is less than all the others, in O(1) from the cached minimum
+        """
+        return None if self.__first is None else self.__first.key
+
+    def find_last_key(self):
+        """
+        Returns the key that is greater than all the others, in O(1) from the cached maximum
+        """
+        return None if self.__last is None else self.__last.key
+
+    def get_root_key(self):
+        """
+        Returns the key contained in the root
+        """
+        # Confirm the root is not None, so we can access it safely
+        if self.root is not None:
+            return self.root.key
+        else:
+            # If the root is none, then the tree is (hopefully) empty so we return none
+            return None
+
+    def floor(self, key):
+        """
+        Returns the largest key less than or equal to the given key, or None if there is none
+        The key itself does not have to be present
+        :param key: the key to search around
+        """
+        node = self.__floor_node(key, True)
+        return None if node is None else node.key
+
+    def ceiling(self, key):
+        """
+        Returns the smallest key greater than or equal to the given key, or None if there is none
+        The key itself does not have to be present
+        :param key: the key to search around
+        """
+        node = self.__ceiling_node(key, True)
+        return None if node is None else node.key
+
+    def lower(self, key):
+        """
+        Returns the largest key strictly less than the given key, or None if there is none
+        The key itself does not have to be present
+        :param key: the key to search around
+        """
+        node = self.__floor_node(key, False)
+        return None if node is None else node.key
+
+    def higher(self, key):
+        """
+        Returns the smallest key strictly greater than the given key, or None if there is none
+        The key itself does not have to be present
+        :param key: the key to search around
+        """
+        node = self.__ceiling_node(key, False)
+        return None if node is None else node.key
+
+    def cursor(self, key=None, mode="ceiling"):
+        """
+        Returns a Cursor positioned with a single descent, which can then step with next() and prev()
+        The cursor is not valid when no entry matches
+        :param key: the key to position around, or None to start on the smallest key
+        :param mode: which entry to land on relative to the key: "floor", "ceiling", "lower" or "higher"
+        """
+        if key is None:
+            return self.Cursor(self.__first)
+        if mode == "floor":
+            node = self.__floor_node(key, True)
+        elif mode == "ceiling":
+            node = self.__ceiling_node(key, True)
+        elif mode == "lower":
+            node = self.__floor_node(key, False)
+        elif mode == "higher":
+            node = self.__ceiling_node(key, False)
+        else:
+            raise ValueError("mode must be one of 'floor', 'ceiling', 'lower' or 'higher'")
+        return self.Cursor(node)
+
+    def find_predecessor(self, key):
+        """
+        Returns the node holding the predecessor of the given key
+        Returns None if the key is not present or has no predecessor
+        :param key: the key to find the predecessor of
+        """
+        node = self.__find_node(key)
+        return None if node is None else self.__prev_live(node)
+
+    def find_successor(self, key):
+        """
+        Returns the node holding the successor of the given key
+        Returns None if the key is not present or has no successor
+        :param key: the key to find the successor of
+        """
+        node = self.__find_node(key)
+        return None if node is None else self.__next_live(node)
+
+    def find_rank(self, key):
+        """
+        Returns the rank of the given key, or returns -1 if the key is not present
+        :param key: the key to find the rank of
+        """
+        curr = self.root
+        total = 0
+        while curr is not None:
+            if key < curr.key:
+                curr = curr.left
+            elif curr.key < key:
+                #everything in the left subtree and the node itself (unless it is a tombstone) come before the key
+                total += curr.subtree_size if curr.right is None else curr.subtree_size - curr.right.subtree_size
+                curr = curr.right
+            elif curr.value is _TOMBSTONE:
+                return -1
+            else:
+                return total if curr.left is None else total + curr.left.subtree_size
+        # If we fall off the tree (or it is empty), the key isn't in it
+        return -1
+
+    def copy(self):
+        """
+        Returns an independent tree with the same entries, options and shape, cloned node for node in O(n)
+        with an explicit stack, so nothing is re-inserted or rebalanced. Keys and values themselves are shared
+        An attached journal and instrumentation are not carried over
+        """
+        clone = self.__empty_like()
+        if self.root is None:
+            return clone
+        with RedBlackTree.__gc_paused():
+            self.__clone_into(clone)
+        return clone
+
+    def __clone_into(self, clone):
+        # Copies the nodes, the value index and the cached extremes into an empty tree with the same options
+        clone.total_size = self.total_size
+        clone.tombstones = self.tombstones
+        if self.value_index is not None:
+            clone.value_index = {value: dict(keys) for value, keys in self.value_index.items()}
+        Node = clone.Node
+        clone.root = top = Node(self.root.key, self.root.value, self.root.color)
+        #(original node, its clone)
+        stack = [(self.root, top)]
+        while stack:
+            node, copied = stack.pop()
+            copied.subtree_size = node.subtree_size
+            copied.aggregate = node.aggregate
+            if node is self.__first:
+                clone.__first = copied
+            if node is self.__last:
+                clone.__last = copied
+            if node.left is not None:
+                child = Node(node.left.key, node.left.value, node.left.color)
+                child.parent = copied
+                copied.left = child
+                stack.append((node.left, child))
+            if node.right is not None:
+                child = Node(node.right.key, node.right.value, node.right.color)
+                child.parent = copied
+                copied.right = child
+                stack.append((node.right, child))
+
+    def __copy__(self):
+        return self.copy()
+
+    def __getstate__(self):
+        # Pickles as the constructor options plus flat key and value lists in key order instead of the linked
+        # nodes, so pickling never recurses and the nodes need no memo entries. Journal and instrumentation stay out
+        options = self.__options()
+        if self.aggregate_ops is not None and self.aggregate_ops[2] is RedBlackTree.__lift_value:
+            #the default lift is private and cannot be pickled by name, the constructor puts it back
+            options["aggregate"] = self.aggregate_ops[:2]
+        return {"options": options, "keys": list(self.keys()), "values": list(self.values())}
+
+    def __setstate__(self, state):
+        # Rebuilds the tree from the flat lists in linear time
+        self.__init__(**state["options"])
+        with RedBlackTree.__gc_paused():
+            self.__link_sorted_nodes([self.Node(key, value, True)
+                                      for key, value in zip(state["keys"], state["values"])])
+
+    @staticmethod
+    @contextlib.contextmanager
+    def __gc_paused():
+        # Turns the cyclic garbage collector off while a whole tree of nodes is allocated. The nodes are all
+        # reachable, so the collections that the allocations would trigger only rescan them and find nothing
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            yield
+        finally:
+            if enabled:
+                gc.enable()
+
+    def freeze(self):
+        """
+        Returns a read-only FrozenRedBlackTree snapshot with the same query API, built in O(n)
+        The snapshot keeps keys and values in sorted arrays instead of nodes and does not follow later changes
+        """
+        return FrozenRedBlackTree(list(self.keys()), list(self.values()), self.__options())
+
+    def dump(self, path):
+        """
+        Writes the tree to a file in a compact binary format that load() reads back in linear time
+        Keys and values are pickled one at a time, so they must be picklable; the aggregate option is not stored
+        The file is written next to the target and renamed over it, so a crash never leaves a half written file
+        :param path: the file to write
+        """
+        dtype_name = b"" if self.key_dtype is None else self.key_dtype.name.encode("ascii")
+        pack_length = TreeFile.LENGTH.pack
+        offsets = []
+        temp_path = str(path) + ".tmp"
+        with open(temp_path, "wb") as file:
+            file.write(TreeFile.HEADER.pack(TreeFile.MAGIC, self.value_index is not None, len(dtype_name),
+                                            self.total_size))
+            file.write(dtype_name)
+            position = file.tell()
+            for node in self.__in_order_nodes():
+                key_bytes = pickle.dumps(node.key, pickle.HIGHEST_PROTOCOL)
+                value_bytes = pickle.dumps(node.value, pickle.HIGHEST_PROTOCOL)
+                offsets.append(position)
+                file.write(pack_length(len(key_bytes)) + key_bytes + pack_length(len(value_bytes)) + value_bytes)
+                position += 2 * TreeFile.LENGTH.size + len(key_bytes) + len(value_bytes)
+            file.write(struct.pack("<%dQ" % len(offsets), *offsets))
+            file.write(TreeFile.OFFSET.pack(position))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path, mapped=False, **options):
+        """
+        Reads a file written by dump()
+        By default the whole file is decoded into a new tree, linked in linear time without any rebalancing. With
+        mapped=True the file is memory-mapped instead and a read-only FrozenRedBlackTree is returned that decodes
+        only the records a query touches, so opening is O(1) and pages are read in lazily; close() it when done
+        Raises ValueError if the file is not in the dump() format
+        :param path: the file to read
+        :param mapped: True to return a lazily paged, read-only view instead of a tree
+        :param options: constructor options overriding the ones stored in the file, such as aggregate
+        """
+        if mapped:
+            view = TreeFile(path)
+            view.options.update(options)
+            return FrozenRedBlackTree(view.keys, view.values, view.options)
+        with open(path, "rb") as file:
+            data = file.read()
+        stored, count, position = TreeFile.read_header(data)
+        stored.update(options)
+        return cls.from_sorted(TreeFile.read_records(data, count, position), **stored)
+
+    def attach_journal(self, path, group_size=64, group_interval=0.01, compact_bytes=64 * 2 ** 20):
+        """
+        Makes the tree durable by logging every change to an append-only journal, returning the Journal object
+        Whatever the journal already holds, from its snapshot and log, is replayed into the tree first, so
+        attaching to the journal of a crashed process restores its tree. If the tree held entries of its own
+        before the replay, a snapshot is written at once so that they are durable too
+        split, join, union, intersection and difference are recorded by writing a new snapshot
+        :param path: the log file; the snapshot is kept at path + ".snapshot"
+        :param group_size: the number of records after which the log is fsynced
+        :param group_interval: the seconds after which pending records are fsynced on the next write. Nothing syncs
+        in the background, so call journal.sync() (or detach_journal()) once writes stop to make the tail durable
+        :param compact_bytes: the log size after which the tree is snapshotted and the log cleared
+        """
+        if self.journal is not None:
+            raise ValueError("a journal is already attached")
+        journal = self.Journal(self, path, group_size, group_interval, compact_bytes)
+        had_entries = self.total_size > 0
+        journal.replay()
+        journal.open()
+        self.journal = journal
+        if had_entries:
+            journal.compact()
+        return journal
+
+    def detach_journal(self):
+        """
+        Syncs and closes the attached journal and stops logging, returning the Journal object
+        """
+        journal = self.journal
+        if journal is None:
+            return None
+        self.journal = None
+        journal.close()
+        return journal
+
+    def select(self, rank):
+        """
+        Returns the key with the given rank
+        Returns None when the rank is invalid
+        :param rank: The rank of the object to be found
+        """
+        if self.root is not None:
+            curr = self.root
+        else:
+            return None
+
+        # Avoiding searching for a rank out of bounds
+        if rank >= self.size() or rank < 0:
+            return None
+
+        while True:
+            left_size = 0 if curr.left is None else curr.left.subtree_size
+            if rank < left_size:
+                curr = curr.left
+            elif rank == left_size and curr.value is not _TOMBSTONE:
+                return curr.key
+            elif curr.right is not None:
+                # Go right and adjust the rank to look in the right subtree, past the live entries on the left
+                rank -= curr.subtree_size - curr.right.subtree_size
+                curr = curr.right
+        return None
+
+    def aggregate(self, lo=None, hi=None, inclusive=(True, True)):
+        """
+        Returns the combined aggregate of the values whose keys lie between lo and hi, in O(log n)
+        The identity is returned for an empty range. Raises ValueError if the tree has no aggregate
+        :param lo: the lower bound, or None for no lower bound
+        :param hi: the upper bound, or None for no upper bound
+        :param inclusive: pair of booleans saying whether lo and hi themselves are included
+        """
+        if self.aggregate_ops is None:
+            raise ValueError("aggregate() needs a tree created with an aggregate")
+        combine, identity, lift = self.aggregate_ops
+        lo_inclusive, hi_inclusive = inclusive
+        if self.tombstones:
+            value_lift = lift
+            lift = lambda value: identity if value is _TOMBSTONE else value_lift(value)
+
+        #find the highest node inside the range, every key in the range lies in its subtree
+        node = self.root
+        while node is not None:
+            key = node.key
+            if lo is not None and (key < lo or (not lo_inclusive and not lo < key)):
+                node = node.right
+            elif hi is not None and (hi < key or (not hi_inclusive and not key < hi)):
+                node = node.left
+            else:
+                break
+        if node is None:
+            return identity
+        split = node
+
+        #left side: collect the parts of split.left that are at or above lo, from the right inwards
+        node = split.left
+        if lo is None:
+            left_total = identity if node is None else node.aggregate
+        else:
+            left_total = identity
+            while node is not None:
+                key = node.key
+                if lo < key or (lo_inclusive and not key < lo):
+                    part = lift(node.value)
+                    if node.right is not None:
+                        part = combine(part, node.right.aggregate)
+                    left_total = combine(part, left_total)
+                    node = node.left
+                else:
+                    node = node.right
+
+        #right side: the parts of split.right that are at or below hi, from the left outwards
+        node = split.right
+        if hi is None:
+            right_total = identity if node is None else node.aggregate
+        else:
+            right_total = identity
+            while node is not None:
+                key = node.key
+                if key < hi or (hi_inclusive and not hi < key):
+                    part = lift(node.value)
+                    if node.left is not None:
+                        part = combine(node.left.aggregate, part)
+                    right_total = combine(right_total, part)
+                    node = node.right
+                else:
+                    node = node.left
+
+        return combine(combine(left_total, lift(split.value)), right_total)
+
+    def count_red_nodes(self):
+        """
+        Returns the number of red nodes in the tree
+        """
+        return self.stats()["red_nodes"]
+
+    def calc_height(self):
+        """
+        Returns the height of the tree from the root through the longest chain
+        """
+        return self.stats()["height"]
+
+    def calc_black_height(self):
+        """
+        Returns the black height of the tree, or 0 for an empty tree
+        :return:
+        """
+        return self.__black_height(self.root)
+
+    def calc_average_depth(self):
+        """
+        Returns the average distance of all nodes to the root
+        """
+        return self.stats()["average_depth"]
+
+    def stats(self):
+        """
+        Returns the shape of the tree, gathered in one iterative pass over every node, as a dict with
+        size (the number of nodes), height (the most links from the root down to a node, 0 for an empty tree),
+        black_height, red_nodes, average_depth (the mean number of links from the root over all nodes, nan for an
+        empty tree), depth_histogram (entry d counts the nodes at depth d) and tombstones (the nodes left by lazy
+        delete mode, which size includes)
+        """
+        histogram = []
+        red_nodes = 0
+        total_depth = 0
+        stack = [] if self.root is None else [(self.root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            #children are popped after their parent, so a depth is at most one past the deepest seen so far
+            if depth == len(histogram):
+                histogram.append(0)
+            histogram[depth] += 1
+            total_depth += depth
+            if not node.color:
+                red_nodes += 1
+            if node.right is not None:
+                stack.append((node.right, depth + 1))
+            if node.left is not None:
+                stack.append((node.left, depth + 1))
+        size = sum(histogram)
+        return {
+            "size": size,
+            "height": max(len(histogram) - 1, 0),
+            "black_height": self.__black_height(self.root),
+            "red_nodes": red_nodes,
+            "average_depth": total_depth / size if size else float("nan"),
+            "depth_histogram": histogram,
+            "tombstones": self.tombstones,
+        }
+
+    def check_invariants(self):
+        """
+        Verifies the whole structure in one iterative pass, raising AssertionError naming the first violation
+        Checks that the root is black, no red link leans right, no red node has a red child, every path down has
+        the same number of black nodes, keys are strictly ascending, subtree_size and the parent links are
+        consistent, the tree size, tombstone count and cached minimum and maximum match, and the aggregates when
+        they are kept
+        Returns True when the tree is valid
+        """
+        root = self.root
+        if root is None:
+            if self.total_size != 0 or self.tombstones != 0 or self.__first is not None or self.__last is not None:
+                raise AssertionError("empty tree with a nonzero size or cached extremes")
+            return True
+        if not root.color:
+            raise AssertionError("the root is red")
+        if root.parent is not None:
+            raise AssertionError("the root has a parent link")
+        if root.subtree_size != self.total_size:
+            raise AssertionError("total_size %d does not match the root subtree_size %d"
+                                 % (self.total_size, root.subtree_size))
+        #taken from the first empty link reached rather than from the left spine, which a cycle could make endless
+        black_height = None
+        visited = 0
+        tombstones = 0
+        nodes = self.total_size + self.tombstones
+        #(node, node bounding it from below, node bounding it from above, black nodes from the root down to it)
+        stack = [(root, None, None, 1)]
+        while stack:
+            node, lower, upper, blacks = stack.pop()
+            visited += 1
+            if visited > nodes:
+                raise AssertionError("more nodes reachable than total_size and tombstones, the links contain a cycle")
+            live = node.value is not _TOMBSTONE
+            if not live:
+                tombstones += 1
+            key = node.key
+            if (lower is not None and not lower.key < key) or (upper is not None and not key < upper.key):
+                raise AssertionError("key %r is out of order" % (key,))
+            left = node.left
+            right = node.right
+            if self.__is_red(right):
+                raise AssertionError("red right link below key %r" % (key,))
+            if not node.color and self.__is_red(left):
+                raise AssertionError("two red links in a row below key %r" % (key,))
+            expected_size = live + self.__get_subtree_size(left) + self.__get_subtree_size(right)
+            if node.subtree_size != expected_size:
+                raise AssertionError("subtree_size %d at key %r, expected %d"
+                                     % (node.subtree_size, key, expected_size))
+            if self.aggregate_ops is not None:
+                stored = node.aggregate
+                self.__update_aggregate(node)
+                if node.aggregate != stored:
+                    node.aggregate = stored
+                    raise AssertionError("stale aggregate at key %r" % (key,))
+            for child in (right, left):
+                if child is None:
+                    if black_height is None:
+                        black_height = blacks
+                    elif blacks != black_height:
+                        raise AssertionError("black height %d below key %r, expected %d" % (blacks, key, black_height))
+                    continue
+                if child.parent is not node:
+                    raise AssertionError("broken parent link below key %r" % (key,))
+                if child is right:
+                    stack.append((child, node, upper, blacks + child.color))
+                else:
+                    stack.append((child, lower, node, blacks + child.color))
+        if tombstones != self.tombstones:
+            raise AssertionError("%d tombstones in the tree, counted %d" % (tombstones, self.tombstones))
+        first = self.__min(root)
+        last = self.__max(root)
+        if first.value is _TOMBSTONE:
+            first = self.__next_live(first)
+        if last.value is _TOMBSTONE:
+            last = self.__prev_live(last)
+        if self.__first is not first or self.__last is not last:
+            raise AssertionError("the cached minimum or maximum is stale")
+        return True
+
+    def display_tree(self, max_depth=None):
+        """
+        Shows the tree in a Tkinter window, which is only imported here so the tree itself never needs a display
+        :param max_depth: the deepest level drawn, deeper subtrees are collapsed into one marker. None draws all
+        """
+        import treeview
+        treeview.display(self, max_depth)
+
+    def to_svg(self, path=None, max_depth=None, labels=None):
+        """
+        Renders the tree offscreen as SVG, returning the document and writing it to path when one is given
+        :param path: optional file to write the SVG to
+        :param max_depth: the deepest level drawn, deeper subtrees are collapsed into one marker. None draws all
+        :param labels: True or False to force key labels on or off, None to show them for small drawings only
+        """
+        import treeview
+        return treeview.to_svg(self, path, max_depth, labels)
+
+    def to_dot(self, path=None, max_depth=None):
+        """
+        Renders the tree as Graphviz DOT source, returning it and writing it to path when one is given
+        :param path: optional file to write the DOT source to
+        :param max_depth: the deepest level drawn, deeper subtrees are collapsed into one marker. None draws all
+        """
+        import treeview
+        return treeview.to_dot(self, path, max_depth)
+
+class FrozenRedBlackTree:
+    """
+    Read-only snapshot of a red black tree, made by RedBlackTree.freeze()
+    Keys and values sit in two parallel arrays in ascending key order instead of in nodes, so lookups are binary
+    searches over contiguous memory, select is O(1) and find_rank is O(log n). thaw() turns it back into a tree
+    """
+
+    def __init__(self, keys, values, options=None):
+        """
+        :param keys: sequence of keys in ascending order, anything supporting len() and integer indexing
+        :param values: sequence of the matching values
+        :param options: constructor options for the tree thaw() builds
+        """
+        self.keys_array = keys
+        self.values_array = values
+        self.options = {} if options is None else dict(options)
+
+    def __len__(self):
+        return len(self.keys_array)
+
+    def __iter__(self):
+        keys = self.keys_array
+        for i in range(len(keys)):
+            yield keys[i]
+
+    def __reversed__(self):
+        keys = self.keys_array
+        for i in range(len(keys) - 1, -1, -1):
+            yield keys[i]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Releases the file behind a snapshot opened with RedBlackTree.load(path, mapped=True); a no-op otherwise
+        """
+        close = getattr(self.keys_array, "close", None)
+        if close is not None:
+            close()
+
+    def size(self):
+        """
+        Returns the number of key-value pairs in the snapshot
+        """
+        return len(self.keys_array)
+
+    def is_empty(self):
+        """
+        Returns true if the snapshot is empty
+        """
+        return len(self.keys_array) == 0
+
+    def thaw(self, **options):
+        """
+        Returns a new mutable RedBlackTree holding the same entries, built in linear time
+        :param options: constructor options overriding the ones of the tree that was frozen
+        """
+        merged = dict(self.options)
+        merged.update(options)
+        return RedBlackTree.from_sorted(self.items(), **merged)
+
+    def __index(self, key):
+        # Position of key in the arrays, or -1 if it is not present
+        keys = self.keys_array
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and not key < keys[i]:
+            return i
+        return -1
+
+    def get(self, key):
+        """
+        Returns the value corresponding to the given key, or None if the key is not present
+        :param key: the key to be searched for
+        """
+        i = self.__index(key)
+        return None if i < 0 else self.values_array[i]
+
+    def get_many(self, keys, default=None):
+        """
+        Returns the values for a batch of keys, in the order the keys were given
+        :param keys: the keys to look up
+        :param default: the value returned for keys that are not present
+        """
+        values = self.values_array
+        result = []
+        for key in keys:
+            i = self.__index(key)
+            result.append(default if i < 0 else values[i])
+        return result
+
+    def contains_key(self, key):
+        """
+        Returns true if the key is present
+        :param key: the key to be searched for
+        """
+        return self.__index(key) >= 0
+
+    def contains_many(self, keys):
+        """
+        Returns a list of booleans saying which of a batch of keys are present
+        :param keys: the keys to look up
+        """
+        return [self.__index(key) >= 0 for key in keys]
+
+    def contains_value(self, value):
+        """
+        Returns true if the value is present, with a scan
+        :param value: The value to search for
+        """
+        return self.reverse_lookup(value) is not None
+
+    def reverse_lookup(self, value):
+        """
+        Returns the smallest key that maps to the value, or None if there is none
+        :param value: the value to search for
+        """
+        values = self.values_array
+        for i in range(len(values)):
+            if values[i] == value:
+                return self.keys_array[i]
+        return None
+
+    def find_rank(self, key):
+        """
+        Returns the rank of the given key, or returns -1 if the key is not present
+        :param key: the key to find the rank of
+        """
+        return self.__index(key)
+
+    def select(self, rank):
+        """
+        Returns the key with the given rank, or None when the rank is invalid
+        :param rank: The rank of the object to be found
+        """
+        if rank < 0 or rank >= len(self.keys_array):
+            return None
+        return self.keys_array[rank]
+
+    def find_first_key(self):
+        """
+        Returns the smallest key, or None when the snapshot is empty
+        """
+        return self.select(0)
+
+    def find_last_key(self):
+        """
+        Returns the largest key, or None when the snapshot is empty
+        """
+        return self.select(len(self.keys_array) - 1)
+
+    def find_predecessor(self, key):
+        """
+        Returns the key before the given key, or None if the key is not present or has no predecessor
+        Unlike RedBlackTree.find_predecessor this returns the key itself, since a snapshot has no nodes
+        :param key: the key to find the predecessor of
+        """
+        i = self.__index(key)
+        return None if i <= 0 else self.keys_array[i - 1]
+
+    def find_successor(self, key):
+        """
+        Returns the key after the given key, or None if the key is not present or has no successor
+        Unlike RedBlackTree.find_successor this returns the key itself, since a snapshot has no nodes
+        :param key: the key to find the successor of
+        """
+        i = self.__index(key)
+        if i < 0 or i + 1 >= len(self.keys_array):
+            return None
+        return self.keys_array[i + 1]
+
+    def floor(self, key):
+        """
+        Returns the largest key less than or equal to the given key, or None if there is none
+        :param key: the key to search around
+        """
+        i = bisect.bisect_right(self.keys_array, key)
+        return self.keys_array[i - 1] if i else None
+
+    def ceiling(self, key):
+        """
+        Returns the smallest key greater than or equal to the given key, or None if there is none
+        :param key: the key to search around
+        """
+        i = bisect.bisect_left(self.keys_array, key)
+        return self.keys_array[i] if i < len(self.keys_array) else None
+
+    def lower(self, key):
+        """
+        Returns the largest key strictly less than the given key, or None if there is none
+        :param key: the key to search around
+        """
+        i = bisect.bisect_left(self.keys_array, key)
+        return self.keys_array[i - 1] if i else None
+
+    def higher(self, key):
+        """
+        Returns the smallest key strictly greater than the given key, or None if there is none
+        :param key: the key to search around
+        """
+        i = bisect.bisect_right(self.keys_array, key)
+        return self.keys_array[i] if i < len(self.keys_array) else None
+
+    def keys(self):
+        """
+        Returns a lazy iterator over the keys in ascending order
+        """
+        return iter(self)
+
+    def values(self):
+        """
+        Returns a lazy iterator over the values in ascending key order
+        """
+        values = self.values_array
+        return (values[i] for i in range(len(values)))
+
+    def items(self):
+        """
+        Returns a lazy iterator over the (key, value) pairs in ascending key order
+        """
+        return self.irange_items()
+
+    def irange(self, lo=None, hi=None, inclusive=(True, True), reverse=False):
+        """
+        Returns a lazy iterator over the keys between lo and hi
+        :param lo: the lower bound, or None for no lower bound
+        :param hi: the upper bound, or None for no upper bound
+        :param inclusive: pair of booleans saying whether lo and hi themselves are included
+        :param reverse: True to iterate from hi down to lo
+        """
+        keys = self.keys_array
+        return (keys[i] for i in self.__range_indices(lo, hi, inclusive, reverse))
+
+    def irange_items(self, lo=None, hi=None, inclusive=(True, True), reverse=False):
+        """
+        Same as irange, but yields (key, value) pairs
+        :param lo: the lower bound, or None for no lower bound
+        :param hi: the upper bound, or None for no upper bound
+        :param inclusive: pair of booleans saying whether lo and hi themselves are included
+        :param reverse: True to iterate from hi down to lo
+        """
+        keys = self.keys_array
+        values = self.values_array
+        return ((keys[i], values[i]) for i in self.__range_indices(lo, hi, inclusive, reverse))
+
+    def __range_indices(self, lo, hi, inclusive, reverse):
+        # The array positions of the keys between lo and hi, as a range object
+        keys = self.keys_array
+        lo_inclusive, hi_inclusive = inclusive
+        if lo is None:
+            start = 0
+        elif lo_inclusive:
+            start = bisect.bisect_left(keys, lo)
+        else:
+            start = bisect.bisect_right(keys, lo)
+        if hi is None:
+            end = len(keys)
+        elif hi_inclusive:
+            end = bisect.bisect_right(keys, hi)
+        else:
+            end = bisect.bisect_left(keys, hi)
+        if reverse:
+            return range(end - 1, start - 1, -1)
+        return range(start, max(start, end))
+
+
+class TreeFile:
+    """
+    The binary format written by RedBlackTree.dump(): a header, one length-prefixed (key, value) record per entry in
+    ascending key order, a table with the file offset of every record, and the offset of that table as the last
+    8 bytes. An instance is a read-only, memory-mapped view of such a file. Records are found through the offset
+    table and decoded only when indexed, so the operating system pages the file in as queries touch it. keys and
+    values are sequences over the records that a FrozenRedBlackTree can search directly
+    """
+    MAGIC = b"RBT1"
+    #magic, index_values flag, length of the key dtype name that follows, record count
+    HEADER = struct.Struct("<4sBHQ")
+    LENGTH = struct.Struct("<I")
+    OFFSET = struct.Struct("<Q")
+
+    class Column:
+        """
+        Sequence of either the keys or the values of the records, decoded on access
+        """
+        __slots__ = ("records", "decode")
+
+        def __init__(self, records, decode):
+            self.records = records
+            self.decode = decode
+
+        def __len__(self):
+            return self.records.count
+
+        def __getitem__(self, index):
+            if index < 0:
+                index += self.records.count
+            if not 0 <= index < self.records.count:
+                raise IndexError("record index out of range")
+            return self.decode(index)
+
+        def close(self):
+            self.records.close()
+
+    def __init__(self, path):
+        """
+        :param path: the file to map
+        """
+        with open(path, "rb") as file:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.options, self.count, _ = TreeFile.read_header(self.buffer)
+            self.table, = TreeFile.OFFSET.unpack_from(self.buffer, len(self.buffer) - TreeFile.OFFSET.size)
+        except ValueError:
+            self.buffer.close()
+            raise
+        self.keys = TreeFile.Column(self, self.key)
+        self.values = TreeFile.Column(self, self.value)
+
+    @staticmethod
+    def read_header(data):
+        """
+        Returns (constructor options, record count, offset of the first record) from the start of a dumped file
+        Raises ValueError if the data is not in the dump() format
+        :param data: the file contents, as any buffer
+        """
+        header = TreeFile.HEADER
+        if len(data) < header.size + TreeFile.OFFSET.size:
+            raise ValueError("not a red black tree file")
+        magic, index_values, dtype_length, count = header.unpack_from(data)
+        if magic != TreeFile.MAGIC:
+            raise ValueError("not a red black tree file")
+        position = header.size + dtype_length
+        dtype_name = bytes(data[header.size:position]).decode("ascii")
+        options = {"index_values": bool(index_values), "key_dtype": dtype_name or None}
+        return options, count, position
+
+    @staticmethod
+    def read_records(data, count, position):
+        """
+        Yields the (key, value) pairs of a dumped file in order, reading the records front to back
+        :param data: the file contents, as any buffer
+        :param count: the record count from the header
+        :param position: the offset of the first record
+        """
+        unpack_length = TreeFile.LENGTH.unpack_from
+        length_size = TreeFile.LENGTH.size
+        view = memoryview(data)
+        for _ in range(count):
+            length, = unpack_length(view, position)
+            position += length_size
+            key = pickle.loads(view[position:position + length])
+            position += length
+            length, = unpack_length(view, position)
+            position += length_size
+            value = pickle.loads(view[position:position + length])
+            position += length
+            yield key, value
+
+    def __record(self, index):
+        # Offset of the pickled key of the record, and its length
+        offset, = TreeFile.OFFSET.unpack_from(self.buffer, self.table + TreeFile.OFFSET.size * index)
+        length, = TreeFile.LENGTH.unpack_from(self.buffer, offset)
+        return offset + TreeFile.LENGTH.size, length
+
+    def key(self, index):
+        """
+        Decodes the key of the record at the given position
+        :param index: position of the record in key order
+        """
+        start, length = self.__record(index)
+        return pickle.loads(self.buffer[start:start + length])
+
+    def value(self, index):
+        """
+        Decodes the value of the record at the given position
+        :param index: position of the record in key order
+        """
+        start, length = self.__record(index)
+        start += length
+        value_length, = TreeFile.LENGTH.unpack_from(self.buffer, start)
+        start += TreeFile.LENGTH.size
+        return pickle.loads(self.buffer[start:start + value_length])
+
+    def close(self):
+        """
+        Unmaps the file. Views over it must not be used afterwards
+        """
+        self.buffer.close()
+
+
+class PersistentRedBlackTree:
+    """
+    Left leaning red black tree with path copying, for cheap snapshots that writers cannot disturb
+    Nodes are never changed once another version can see them: an update copies the nodes on its search path and
+    shares every untouched subtree, so it costs O(log n) extra memory. snapshot() returns a new handle on the
+    current version in O(1). Both handles can keep reading and writing without affecting each other
+    """
+    class Node:
+        __slots__ = ("key", "value", "color", "subtree_size", "left", "right", "owner")
+
+        def __init__(self, key, value, color, owner):
+            self.key = key
+            self.value = value
+            self.color = color
+            self.subtree_size = 1
+            self.left = None
+            self.right = None
+            #the handle token that may still change this node in place; any other node is copied before a write
+            self.owner = owner
+
+    def __init__(self):
+        self.root = None
+        self.__owner = object()
+
+    @classmethod
+    def from_tree(cls, tree):
+        """
+        Builds a persistent tree with the same entries and shape as a RedBlackTree, in linear time
+        :param tree: the RedBlackTree to copy
+        """
+        persistent = cls()
+        if tree.tombstones:
+            #the shape is copied as is, so lazily deleted entries have to be dropped first
+            tree = RedBlackTree.from_sorted(tree.items())
+        persistent.root = persistent.__copy_structure(tree.root)
+        return persistent
+
+    @classmethod
+    def from_sorted(cls, items):
+        """
+        Builds a persistent tree from (key, value) pairs given in ascending key order in linear time
+        Raises ValueError if the keys are not in ascending order
+        :param items: iterable of (key, value) pairs sorted by key
+        """
+        return cls.from_tree(RedBlackTree.from_sorted(items))
+
+    def __copy_structure(self, node):
+        # Copies a RedBlackTree subtree node for node, keeping colors and sizes
+        if node is None:
+            return None
+        copy = self.Node(node.key, node.value, node.color, self.__owner)
+        copy.subtree_size = node.subtree_size
+        copy.left = self.__copy_structure(node.left)
+        copy.right = self.__copy_structure(node.right)
+        return copy
+
+    def to_tree(self, **options):
+        """
+        Returns a new mutable RedBlackTree holding the entries of this version, built in linear time
+        :param options: constructor options for the new tree
+        """
+        return RedBlackTree.from_sorted(self.items(), **options)
+
+    def snapshot(self):
+        """
+        Returns a new handle on the current version in O(1)
+        Writes to either handle afterwards copy the nodes they touch, so neither sees the other's changes
+        """
+        #neither handle owns the current nodes any more, so both copy before writing
+        self.__owner = object()
+        other = type(self)()
+        other.root = self.root
+        return other
+
+    def __len__(self):
+        return 0 if self.root is None else self.root.subtree_size
+
+    def __iter__(self):
+        return (node.key for node in self.__irange_nodes(None, None, (True, True), False))
+
+    def __reversed__(self):
+        return (node.key for node in self.__irange_nodes(None, None, (True, True), True))
+
+    def size(self):
+        """
+        Returns the number of key-value pairs in this version
+        """
+        return len(self)
+
+    def is_empty(self):
+        """
+        Returns true if this version is empty
+        """
+        return self.root is None
+
+    def __own(self, node):
+        # Returns node itself if this handle may change it, otherwise a copy this handle owns
+        if node.owner is self.__owner:
+            return node
+        copy = self.Node(node.key, node.value, node.color, self.__owner)
+        copy.subtree_size = node.subtree_size
+        copy.left = node.left
+        copy.right = node.right
+        return copy
+
+    @staticmethod
+    def __is_red(node):
+        return node is not None and not node.color
+
+    @staticmethod
+    def __size(node):
+        return 0 if node is None else node.subtree_size
+
+    def __rotate_left(self, node):
+        # node is owned; its right child is copied before it moves up
+        x = self.__own(node.right)
+        node.right = x.left
+        x.left = node
+        x.color = node.color
+        node.color = False
+        x.subtree_size = node.subtree_size
+        node.subtree_size = 1 + self.__size(node.left) + self.__size(node.right)
+        return x
+
+    def __rotate_right(self, node):
+        # node is owned; its left child is copied before it moves up
+        x = self.__own(node.left)
+        node.left = x.right
+        x.right = node
+        x.color = node.color
+        node.color = False
+        x.subtree_size = node.subtree_size
+        node.subtree_size = 1 + self.__size(node.left) + self.__size(node.right)
+        return x
+
+    def __flip_colors(self, node):
+        # node is owned; both children change color, so both are copied
+        node.color = not node.color
+        node.left = self.__own(node.left)
+        node.left.color = not node.left.color
+        node.right = self.__own(node.right)
+        node.right.color = not node.right.color
+
+    def __balance(self, node):
+        # Restores the left leaning invariants at an owned node on the way back up, and its size
+        if self.__is_red(node.right) and not self.__is_red(node.left):
+            node = self.__rotate_left(node)
+        if self.__is_red(node.left) and self.__is_red(node.left.left):
+            node = self.__rotate_right(node)
+        if self.__is_red(node.left) and self.__is_red(node.right):
+            self.__flip_colors(node)
+        node.subtree_size = 1 + self.__size(node.left) + self.__size(node.right)
+        return node
+
+    def __move_red_left(self, node):
+        self.__flip_colors(node)
+        if self.__is_red(node.right.left):
+            node.right = self.__rotate_right(node.right)
+            node = self.__rotate_left(node)
+            self.__flip_colors(node)
+        return node
+
+    def __move_red_right(self, node):
+        self.__flip_colors(node)
+        if self.__is_red(node.left.left):
+            node = self.__rotate_right(node)
+            self.__flip_colors(node)
+        return node
+
+    def put(self, key, value):
+        """
+        Inserts or overwrites a key-value pair, copying only the search path
+        The recursion is as deep as the tree, which is at most about 2 log2(n)
+        :param key: the key to be inserted
+        :param value: the value to be inserted
+        """
+        root = self.__put(self.root, key, value)
+        if not root.color:
+            root = self.__own(root)
+            root.color = True
+        self.root = root
+
+    def __put(self, node, key, value):
+        if node is None:
+            return self.Node(key, value, False, self.__owner)
+        node = self.__own(node)
+        if key < node.key:
+            node.left = self.__put(node.left, key, value)
+        elif node.key < key:
+            node.right = self.__put(node.right, key, value)
+        else:
+            node.value = value
+            return node
+        return self.__balance(node)
+
+    def delete(self, key):
+        """
+        Removes a key-value pair, returning the deleted value, or None if the key wasn't present
+        Only the search path is copied, other versions keep the entry
+        :param key: the key to be deleted
+        """
+        node = self.__find_node(key)
+        if node is None:
+            return None
+        value = node.value
+        root = self.root
+        if not self.__is_red(root.left) and not self.__is_red(root.right):
+            root = self.__own(root)
+            root.color = False
+        root = self.__delete(root, key)
+        if root is not None and not root.color:
+            root = self.__own(root)
+            root.color = True
+        self.root = root
+        return value
+
+    def __delete(self, node, key):
+        # Top-down delete of a key that is present, on an owned copy of the search path
+        node = self.__own(node)
+        if key < node.key:
+            if not self.__is_red(node.left) and not self.__is_red(node.left.left):
+                node = self.__move_red_left(node)
+            node.left = self.__delete(node.left, key)
+        else:
+            if self.__is_red(node.left):
+                node = self.__rotate_right(node)
+            if not node.key < key and node.right is None:
+                return None
+            if not self.__is_red(node.right) and not self.__is_red(node.right.left):
+                node = self.__move_red_right(node)
+            if not node.key < key:
+                #node is a private copy, so taking over the successor's entry is invisible to other versions
+                successor = node.right
+                while successor.left is not None:
+                    successor = successor.left
+                node.key = successor.key
+                node.value = successor.value
+                node.right = self.__delete_min(node.right)
+            else:
+                node.right = self.__delete(node.right, key)
+        return self.__balance(node)
+
+    def __delete_min(self, node):
+        node = self.__own(node)
+        if node.left is None:
+            return None
+        if not self.__is_red(node.left) and not self.__is_red(node.left.left):
+            node = self.__move_red_left(node)
+        node.left = self.__delete_min(node.left)
+        return self.__balance(node)
+
+    def __find_node(self, key):
+        # The node holding key, or None if the key is not present
+        node = self.root
+        while node is not None:
+            if key < node.key:
+                node = node.left
+            elif node.key < key:
+                node = node.right
+            else:
+                return node
+        return None
+
+    def get(self, key):
+        """
+        Returns the value corresponding to the given key, or None if the key is not present
+        :param key: the key to be searched for
+        """
+        node = self.__find_node(key)
+        return None if node is None else node.value
+
+    def contains_key(self, key):
+        """
+        Returns true if the key is present
+        :param key: the key to be searched for
+        """
+        return self.__find_node(key) is not None
+
+    def get_many(self, keys, default=None):
+        """
+        Returns the values for a batch of keys, in the order the keys were given
+        :param keys: the keys to look up
+        :param default: the value returned for keys that are not present
+        """
+        result = []
+        for key in keys:
+            node = self.__find_node(key)
+            result.append(default if node is None else node.value)
+        return result
+
+    def contains_value(self, value):
+        """
+        Returns true if the value is present, with a scan
+        :param value: The value to search for
+        """
+        return any(node.value == value for node in self.__irange_nodes(None, None, (True, True), False))
+
+    def find_rank(self, key):
+        """
+        Returns the rank of the given key, or returns -1 if the key is not present
+        :param key: the key to find the rank of
+        """
+        node = self.root
+        total = 0
+        while node is not None:
+            if key < node.key:
+                node = node.left
+            elif node.key < key:
+                total += self.__size(node.left) + 1
+                node = node.right
+            else:
+                return total + self.__size(node.left)
+        return -1
+
+    def select(self, rank):
+        """
+        Returns the key with the given rank, or None when the rank is invalid
+        :param rank: The rank of the object to be found
+        """
+        if rank < 0 or rank >= len(self):
+            return None
+        node = self.root
+        while True:
+            left_size = self.__size(node.left)
+            if rank < left_size:
+                node = node.left
+            elif rank > left_size:
+                rank -= left_size + 1
+                node = node.right
+            else:
+                return node.key
+
+    def find_first_key(self):
+        """
+        Returns the smallest key, or None when the tree is empty
+        """
+        return self.select(0)
+
+    def find_last_key(self):
+        """
+        Returns the largest key, or None when the tree is empty
+        """
+        return self.select(len(self) - 1)
+
+    def floor(self, key):
+        """
+        Returns the largest key less than or equal to the given key, or None if there is none
+        :param key: the key to search around
+        """
+        return self.__bound(key, True, True)
+
+    def ceiling(self, key):
+        """
+        Returns the smallest key greater than or equal to the given key, or None if there is none
+        :param key: the key to search around
+        """
+        return self.__bound(key, True, False)
+
+    def lower(self, key):
+        """
+        Returns the largest key strictly less than the given key, or None if there is none
+        :param key: the key to search around
+        """
+        return self.__bound(key, False, True)
+
+    def higher(self, key):
+        """
+        Returns the smallest key strictly greater than the given key, or None if there is none
+        :param key: the key to search around
+        """
+        return self.__bound(key, False, False)
+
+    def __bound(self, key, inclusive, below):
+        # The nearest key below (or above) the given key in one descent
+        node = self.root
+        best = None
+        while node is not None:
+            if inclusive and not key < node.key and not node.key < key:
+                return node.key
+            if (node.key < key) if below else (key < node.key):
+                best = node
+                node = node.right if below else node.left
+            else:
+                node = node.left if below else node.right
+        return None if best is None else best.key
+
+    def keys(self):
+        """
+        Returns a lazy iterator over the keys in ascending order
+        """
+        return iter(self)
+
+    def values(self):
+        """
+        Returns a lazy iterator over the values in ascending key order
+        """
+        return (node.value for node in self.__irange_nodes(None, None, (True, True), False))
+
+    def items(self):
+        """
+        Returns a lazy iterator over the (key, value) pairs in ascending key order
+        """
+        return self.irange_items()
+
+    def irange(self, lo=None, hi=None, inclusive=(True, True), reverse=False):
+        """
+        Returns a lazy iterator over the keys between lo and hi
+        :param lo: the lower bound, or None for no lower bound
+        :param hi: the upper bound, or None for no upper bound
+        :param inclusive: pair of booleans saying whether lo and hi themselves are included
+        :param reverse: True to iterate from hi down to lo
+        """
+        return (node.key for node in self.__irange_nodes(lo, hi, inclusive, reverse))
+
+    def irange_items(self, lo=None, hi=None, inclusive=(True, True), reverse=False):
+        """
+        Same as irange, but yields (key, value) pairs
+        :param lo: the lower bound, or None for no lower bound
+        :param hi: the upper bound, or None for no upper bound
+        :param inclusive: pair of booleans saying whether lo and hi themselves are included
+        :param reverse: True to iterate from hi down to lo
+        """
+        return ((node.key, node.value) for node in self.__irange_nodes(lo, hi, inclusive, reverse))
+
+    def __irange_nodes(self, lo, hi, inclusive, reverse):
+        # In-order walk with an explicit stack, since nodes have no parent links; subtrees outside the bounds are
+        # never entered. The version being walked never changes, so writes during the walk are harmless
+        lo_inclusive, hi_inclusive = inclusive
+        first, last = (hi, lo) if reverse else (lo, hi)
+        first_inclusive, last_inclusive = (hi_inclusive, lo_inclusive) if reverse else (lo_inclusive, hi_inclusive)
+
+        def before_first(key):
+            # True if key lies outside the bound the walk starts from
+            if first is None:
+                return False
+            if reverse:
+                return first < key if first_inclusive else not key < first
+            return key < first if first_inclusive else not first < key
+
+        def after_last(key):
+            # True if key lies outside the bound the walk stops at
+            if last is None:
+                return False
+            if reverse:
+                return key < last if last_inclusive else not last < key
+            return last < key if last_inclusive else not key < last
+
+        stack = []
+        node = self.root
+        while True:
+            while node is not None:
+                if before_first(node.key):
+                    node = node.left if reverse else node.right
+                else:
+                    stack.append(node)
+                    node = node.right if reverse else node.left
+            if not stack:
+                return
+            node = stack.pop()
+            if after_last(node.key):
+                return
+            yield node
+            node = node.left if reverse else node.right
+
+
+class ReadWriteLock:
+    """
+    Lock that lets any number of readers in at once, or a single writer
+    Writers are preferred: once a writer waits, new readers queue behind it, so a steady stream of readers cannot
+    starve an ingest thread. Not reentrant, a thread holding the read side must not ask for the write side
+    """
+
+    def __init__(self):
+        self.__condition = threading.Condition(threading.Lock())
+        self.__readers = 0
+        self.__writing = False
+        self.__waiting_writers = 0
+
+    def acquire_read(self):
+        with self.__condition:
+            while self.__writing or self.__waiting_writers:
+                self.__condition.wait()
+            self.__readers += 1
+
+    def release_read(self):
+        with self.__condition:
+            self.__readers -= 1
+            if self.__readers == 0:
+                self.__condition.notify_all()
+
+    def acquire_write(self):
+        with self.__condition:
+            self.__waiting_writers += 1
+            while self.__writing or self.__readers:
+                self.__condition.wait()
+            self.__waiting_writers -= 1
+            self.__writing = True
+
+    def release_write(self):
+        with self.__condition:
+            self.__writing = False
+            self.__condition.notify_all()
+
+    @contextlib.contextmanager
+    def reading(self):
+        """
+        Context manager holding the read side
+        """
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextlib.contextmanager
+    def writing(self):
+        """
+        Context manager holding the write side
+        """
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+class ConcurrentRedBlackTree:
+    """
+    Thread-safe ordered map for many reader threads next to writer threads
+    By default a RedBlackTree is guarded by a ReadWriteLock: readers share the lock and a writer holds it alone.
+    With lock_free_reads=True the entries live in a PersistentRedBlackTree instead. Writers still serialize on the
+    lock, and after every write or batch they publish an O(1) snapshot of the new version. Readers query the last
+    published version without taking any lock, and a version never changes once published
+    """
+
+    def __init__(self, lock_free_reads=False, **options):
+        """
+        :param lock_free_reads: True to serve reads from published persistent snapshots without locking
+        :param options: constructor options for the RedBlackTree behind the default mode
+        """
+        self.lock = ReadWriteLock()
+        self.lock_free_reads = lock_free_reads
+        if lock_free_reads:
+            if options:
+                raise ValueError("tree options are not supported with lock_free_reads")
+            self.tree = PersistentRedBlackTree()
+            #the version readers see, replaced (never changed) by writers
+            self.published = self.tree.snapshot()
+        else:
+            self.tree = RedBlackTree(**options)
+            self.published = None
+
+    def __read(self, name, *args):
+        # Runs a read-only query against the published version, or against the tree under the read lock
+        published = self.published
+        if published is not None:
+            return getattr(published, name)(*args)
+        with self.lock.reading():
+            return getattr(self.tree, name)(*args)
+
+    def __publish(self):
+        # Makes the current version of the persistent tree visible to readers. Called with the write lock held
+        if self.lock_free_reads:
+            self.published = self.tree.snapshot()
+
+    def __len__(self):
+        return self.__read("size")
+
+    def size(self):
+        """
+        Returns the number of key-value pairs
+        """
+        return self.__read("size")
+
+    def get(self, key):
+        """
+        Returns the value corresponding to the given key, or None if the key is not present
+        :param key: the key to be searched for
+        """
+        return self.__read("get", key)
+
+    def get_many(self, keys, default=None):
+        """
+        Returns the values for a batch of keys, all read from one consistent version
+        :param keys: the keys to look up
+        :param default: the value returned for keys that are not present
+        """
+        return self.__read("get_many", keys, default)
+
+    def contains_key(self, key):
+        """
+        Returns true if the key is present
+        :param key: the key to be searched for
+        """
+        return self.__read("contains_key", key)
+
+    def find_rank(self, key):
+        """
+        Returns the rank of the given key, or returns -1 if the key is not present
+        :param key: the key to find the rank of
+        """
+        return self.__read("find_rank", key)
+
+    def select(self, rank):
+        """
+        Returns the key with the given rank, or None when the rank is invalid
+        :param rank: The rank of the object to be found
+        """
+        return self.__read("select", rank)
+
+    def floor(self, key):
+        """
+        Returns the largest key less than or equal to the given key, or None if there is none
+        :param key: the key to search around
+        """
+        return self.__read("floor", key)
+
+    def ceiling(self, key):
+        """
+        Returns the smallest key greater than or equal to the given key, or None if there is none
+        :param key: the key to search around
+        """
+        return self.__read("ceiling", key)
+
+    def lower(self, key):
+        """
+        Returns the largest key strictly less than the given key, or None if there is none
+        :param key: the key to search around
+        """
+        return self.__read("lower", key)
+
+    def higher(self, key):
+        """
+        Returns the smallest key strictly greater than the given key, or None if there is none
+        :param key: the key to search around
+        """
+        return self.__read("higher", key)
+
+    def items(self, lo=None, hi=None, inclusive=(True, True)):
+        """
+        Returns the (key, value) pairs between lo and hi as a list, all read from one consistent version
+        A list rather than a lazy iterator, so the read lock is not held while the caller consumes it
+        :param lo: the lower bound, or None for no lower bound
+        :param hi: the upper bound, or None for no upper bound
+        :param inclusive: pair of booleans saying whether lo and hi themselves are included
+        """
+        published = self.published
+        if published is not None:
+            return list(published.irange_items(lo, hi, inclusive))
+        with self.lock.reading():
+            return list(self.tree.irange_items(lo, hi, inclusive))
+
+    def snapshot(self):
+        """
+        Returns a view that later writes do not change: with lock_free_reads an O(1) PersistentRedBlackTree handle
+        of the published version, private to the caller so writing to it never reaches other readers, otherwise a
+        FrozenRedBlackTree made under the read lock in O(n)
+        """
+        published = self.published
+        if published is not None:
+            return published.snapshot()
+        with self.lock.reading():
+            return self.tree.freeze()
+
+    def put(self, key, value):
+        """
+        Inserts or overwrites a key-value pair under the write lock
+        :param key: the key to be inserted
+        :param value: the value to be inserted
+        """
+        with self.lock.writing():
+            self.tree.put(key, value)
+            self.__publish()
+
+    def delete(self, key):
+        """
+        Removes a key-value pair under the write lock, returning the deleted value or None
+        :param key: the key to be deleted
+        """
+        with self.lock.writing():
+            value = self.tree.delete(key)
+            self.__publish()
+        return value
+
+    def put_many(self, items):
+        """
+        Inserts a batch of (key, value) pairs with a single acquisition of the write lock and a single publish
+        :param items: iterable of (key, value) pairs
+        """
+        items = list(items)
+        with self.lock.writing():
+            if self.lock_free_reads:
+                for key, value in items:
+                    self.tree.put(key, value)
+            else:
+                self.tree.put_many(items)
+            self.__publish()
+
+    def delete_many(self, keys):
+        """
+        Removes a batch of keys with a single acquisition of the write lock, returning how many were present
+        :param keys: the keys to be deleted
+        """
+        keys = list(keys)
+        removed = 0
+        with self.lock.writing():
+            for key in keys:
+                if self.tree.contains_key(key):
+                    self.tree.delete(key)
+                    removed += 1
+            self.__publish()
+        return removed
+
+    @contextlib.contextmanager
+    def write_batch(self):
+        """
+        Context manager that holds the write lock for a whole batch of writes and yields the underlying tree
+        (a RedBlackTree, or a PersistentRedBlackTree with lock_free_reads) to apply them to. Readers see either none
+        or all of the batch. With lock_free_reads the batch is published once when the block exits, and a block that
+        raises rolls the tree back to the last published version, so readers never see any of it. Without it
+        nothing is undone: a block that raises leaves the writes it made before the error applied
+        """
+        with self.lock.writing():
+            try:
+                yield self.tree
+            except BaseException:
+                if self.lock_free_reads:
+                    #the published version shares no node the batch may have changed, writes copy before changing
+                    self.tree.root = self.published.root
+                raise
+            self.__publish()
+
+
+class ShardProcess:
+    """
+    A RedBlackTree kept in a long-lived worker process of its own, the shard of a ShardedRedBlackTree created with
+    processes=True. Every call goes over a pipe, so keys, values and results must be picklable. send() and receive()
+    are separate so one operation can be started on several shards before the results are collected, which runs
+    the workers in parallel
+    """
+
+    def __init__(self, options, context=None):
+        """
+        :param options: constructor options for the tree in the worker
+        :param context: optional multiprocessing context to start the worker with
+        """
+        context = context if context is not None else multiprocessing.get_context()
+        connection, worker_connection = context.Pipe()
+        self.process = context.Process(target=ShardProcess.serve, args=(worker_connection, options), daemon=True)
+        self.process.start()
+        worker_connection.close()
+        self.connection = connection
+        #the size of the worker's tree, sent back with every result
+        self.total_size = 0
+
+    def send(self, name, *args):
+        """
+        Starts a tree method in the worker without waiting for it
+        :param name: the RedBlackTree method to call
+        :param args: its arguments
+        """
+        self.connection.send((name, args))
+
+    def receive(self):
+        """
+        Waits for the result of the oldest call sent, raising the exception it raised in the worker
+        """
+        ok, result, self.total_size = self.connection.recv()
+        if not ok:
+            raise result
+        return result
+
+    def call(self, name, *args):
+        """
+        Runs a tree method in the worker and returns its result
+        :param name: the RedBlackTree method to call
+        :param args: its arguments
+        """
+        self.send(name, *args)
+        return self.receive()
+
+    def close(self):
+        """
+        Stops the worker, dropping its tree
+        """
+        if self.process is None:
+            return
+        self.connection.send((None, ()))
+        self.process.join()
+        self.connection.close()
+        self.process = None
+
+    @staticmethod
+    def serve(connection, options):
+        """
+        The worker's loop: applies the calls that arrive on the connection to its tree until it is told to stop
+        Iterators are returned as lists
+        :param connection: the worker's end of the pipe
+        :param options: constructor options for the tree
+        """
+        tree = RedBlackTree(**options)
+        while True:
+            name, args = connection.recv()
+            if name is None:
+                break
+            try:
+                result = getattr(tree, name)(*args)
+                if hasattr(result, "__next__"):
+                    result = list(result)
+                reply = (True, result, tree.total_size)
+            except Exception as error:
+                reply = (False, error, tree.total_size)
+            connection.send(reply)
+        connection.close()
+
+
+class ShardedRedBlackTree:
+    """
+    Ordered map whose key space is cut into ranges by split points, each range held by its own RedBlackTree shard
+    Shard i holds the keys from split_points[i - 1] up to, but not including, split_points[i]. Point queries are
+    routed with one bisect over the split points, global ranks add up the sizes of the shards before, and range
+    scans chain the shards in order. When a write leaves a shard more than max_skew times the average size, the
+    split points are recomputed with O(log n) joins and splits.
+    With processes=True every shard is a ShardProcess, a tree in a worker process of its own, so a tree is no longer
+    limited to one core: put_many hands each worker its part of the batch and range scans query the overlapping
+    workers, all of them at once. Point queries then pay a round trip over a pipe, and rebalancing moves the
+    entries that change shard instead of joining and splitting. close() stops the workers
+    """
+
+    def __init__(self, shards=4, split_points=None, max_skew=2.0, min_rebalance_size=1024, processes=False,
+                 **options):
+        """
+        :param shards: the number of shards to spread the keys over
+        :param split_points: optional initial split points, shards - 1 ascending keys. Without them all keys go
+        to one shard until there are min_rebalance_size of them, and the split points are then chosen from the data
+        :param max_skew: how many times the average shard size a shard may grow before the keys are rebalanced,
+        or None to only rebalance when rebalance() is called
+        :param min_rebalance_size: the smallest total size at which automatic rebalancing happens
+        :param processes: True to keep every shard in a worker process of its own
+        :param options: constructor options for every shard, such as index_values
+        """
+        if shards < 1:
+            raise ValueError("shards must be at least 1")
+        self.shard_count = shards
+        self.processes = processes
+        self.max_skew = max_skew
+        self.min_rebalance_size = min_rebalance_size
+        self.options = options
+        if split_points is None:
+            self.split_points = []
+        else:
+            self.split_points = list(split_points)
+            if len(self.split_points) != shards - 1:
+                raise ValueError("split_points must hold shards - 1 keys")
+            for i in range(1, len(self.split_points)):
+                if not self.split_points[i - 1] < self.split_points[i]:
+                    raise ValueError("split_points must be strictly ascending")
+        self.shards = [self.__new_shard() for _ in range(len(self.split_points) + 1)]
+        self.total_size = 0
+
+    def __new_shard(self):
+        if self.processes:
+            return ShardProcess(self.options)
+        return RedBlackTree(**self.options)
+
+    def __call(self, shard, name, *args):
+        # Runs a tree method on a shard, in this process or in the shard's worker
+        if self.processes:
+            return shard.call(name, *args)
+        return getattr(shard, name)(*args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Stops the worker processes of a tree created with processes=True; a no-op otherwise
+        """
+        if self.processes:
+            for shard in self.shards:
+                shard.close()
+
+    def __len__(self):
+        return self.total_size
+
+    def __iter__(self):
+        return self.irange()
+
+    def size(self):
+        """
+        Returns the number of key-value pairs over all shards
+        """
+        return self.total_size
+
+    def shard_index(self, key):
+        """
+        Returns the index of the shard the key belongs to
+        :param key: the key to route
+        """
+        return bisect.bisect_right(self.split_points, key)
+
+    def shard_sizes(self):
+        """
+        Returns the number of entries in each shard
+        """
+        return [shard.total_size for shard in self.shards]
+
+    def put(self, key, value):
+        """
+        Inserts or overwrites a key-value pair in the shard that owns the key
+        :param key: the key to be inserted
+        :param value: the value to be inserted
+        """
+        shard = self.shards[bisect.bisect_right(self.split_points, key)]
+        before = shard.total_size
+        self.__call(shard, "put", key, value)
+        self.total_size += shard.total_size - before
+        if shard.total_size > before:
+            self.__check_skew(shard.total_size)
+
+    def delete(self, key):
+        """
+        Removes a key-value pair, returning the deleted value, or None if the key wasn't present
+        :param key: the key to be deleted
+        """
+        shard = self.shards[bisect.bisect_right(self.split_points, key)]
+        before = shard.total_size
+        value = self.__call(shard, "delete", key)
+        self.total_size += shard.total_size - before
+        return value
+
+    def get(self, key):
+        """
+        Returns the value corresponding to the given key, or None if the key is not present
+        :param key: the key to be searched for
+        """
+        return self.__call(self.shards[bisect.bisect_right(self.split_points, key)], "get", key)
+
+    def contains_key(self, key):
+        """
+        Returns true if the key is present
+        :param key: the key to be searched for
+        """
+        return self.__call(self.shards[bisect.bisect_right(self.split_points, key)], "contains_key", key)
+
+    def find_rank(self, key):
+        """
+        Returns the global rank of the given key, or returns -1 if the key is not present
+        :param key: the key to find the rank of
+        """
+        index = bisect.bisect_right(self.split_points, key)
+        rank = self.__call(self.shards[index], "find_rank", key)
+        if rank < 0:
+            return -1
+        for shard in self.shards[:index]:
+            rank += shard.total_size
+        return rank
+
+    def select(self, rank):
+        """
+        Returns the key with the given global rank, or None when the rank is invalid
+        :param rank: The rank of the object to be found
+        """
+        if rank < 0 or rank >= self.total_size:
+            return None
+        for shard in self.shards:
+            if rank < shard.total_size:
+                return self.__call(shard, "select", rank)
+            rank -= shard.total_size
+        return None
+
+    def irange(self, lo=None, hi=None, inclusive=(True, True), reverse=False):
+        """
+        Returns a lazy iterator over the keys between lo and hi, visiting only the shards that overlap the range
+        :param lo: the lower bound, or None for no lower bound
+        :param hi: the upper bound, or None for no upper bound
+        :param inclusive: pair of booleans saying whether lo and hi themselves are included
+        :param reverse: True to iterate from hi down to lo
+        """
+        return (key for key, value in self.irange_items(lo, hi, inclusive, reverse))
+
+    def irange_items(self, lo=None, hi=None, inclusive=(True, True), reverse=False):
+        """
+        Same as irange, but yields (key, value) pairs
+        With processes=True the overlapping workers are all queried at once when iteration starts, each returning
+        its part of the range as a list
+        :param lo: the lower bound, or None for no lower bound
+        :param hi: the upper bound, or None for no upper bound
+        :param inclusive: pair of booleans saying whether lo and hi themselves are included
+        :param reverse: True to iterate from hi down to lo
+        """
+        first = 0 if lo is None else bisect.bisect_right(self.split_points, lo)
+        last = len(self.shards) - 1 if hi is None else bisect.bisect_right(self.split_points, hi)
+        shards = self.shards[first:last + 1]
+        if reverse:
+            shards.reverse()
+        if self.processes:
+            for shard in shards:
+                shard.send("irange_items", lo, hi, inclusive, reverse)
+            # Every result is received before the first yield, so an abandoned iterator leaves no reply in a pipe
+            shards = [shard.receive() for shard in shards]
+        for shard in shards:
+            yield from shard if self.processes else shard.irange_items(lo, hi, inclusive, reverse)
+
+    def items(self):
+        """
+        Returns a lazy iterator over the (key, value) pairs in ascending key order
+        """
+        return self.irange_items()
+
+    def delete_range(self, lo=None, hi=None, inclusive=(True, True)):
+        """
+        Removes every key between lo and hi from the shards that overlap the range, returning how many were removed
+        :param lo: the lower bound, or None for no lower bound
+        :param hi: the upper bound, or None for no upper bound
+        :param inclusive: pair of booleans saying whether lo and hi themselves are removed
+        """
+        first = 0 if lo is None else bisect.bisect_right(self.split_points, lo)
+        last = len(self.shards) - 1 if hi is None else bisect.bisect_right(self.split_points, hi)
+        shards = self.shards[first:last + 1]
+        if self.processes:
+            for shard in shards:
+                shard.send("delete_range", lo, hi, inclusive)
+            removed = sum(shard.receive() for shard in shards)
+        else:
+            removed = sum(shard.delete_range(lo, hi, inclusive) for shard in shards)
+        self.total_size -= removed
+        return removed
+
+    def put_many(self, items):
+        """
+        Inserts a batch of (key, value) pairs, in any order
+        The batch is partitioned by shard and each shard takes its part with its linear-time put_many merge. With
+        processes=True every worker is sent its part before any result is awaited, so the shards are built in
+        parallel. When a key repeats, the last value given for it is kept
+        :param items: iterable of (key, value) pairs
+        """
+        split_points = self.split_points
+        parts = [[] for _ in self.shards]
+        for item in items:
+            parts[bisect.bisect_right(split_points, item[0])].append(item)
+        for shard, part in zip(self.shards, parts):
+            if part:
+                if self.processes:
+                    shard.send("put_many", part)
+                else:
+                    shard.put_many(part)
+        if self.processes:
+            for shard, part in zip(self.shards, parts):
+                if part:
+                    shard.receive()
+        self.total_size = sum(shard.total_size for shard in self.shards)
+        self.__check_skew(max(shard.total_size for shard in self.shards))
+
+    def __check_skew(self, largest):
+        # Rebalances when a shard has grown past max_skew times the average, or the shards have yet to be made
+        if self.max_skew is None or self.total_size < self.min_rebalance_size:
+            return
+        if len(self.shards) < self.shard_count or largest * self.shard_count > self.max_skew * self.total_size:
+            self.rebalance()
+
+    def rebalance(self):
+        """
+        Recomputes the split points so every shard holds an equal share of the keys
+        The shards are joined into one tree and split again at the new points, O(shards * log n) in all. With
+        processes=True the workers instead hand over the entries that now belong to another shard
+        """
+        count = min(self.shard_count, self.total_size) or 1
+        if self.processes:
+            self.__move_entries(count)
+            return
+        whole = self.shards[0]
+        for shard in self.shards[1:]:
+            whole.join(shard)
+        split_points = [whole.select(i * self.total_size // count) for i in range(1, count)]
+        shards = []
+        for key in reversed(split_points):
+            shards.append(whole.split(key))
+        shards.append(whole)
+        shards.reverse()
+        self.shards = shards
+        self.split_points = split_points
+
+    def __move_entries(self, count):
+        # Rebalances worker shards: the new split points come from global selects, then every worker pops the keys
+        # outside its new range and the popped entries go to the shards that own them now, in parallel both times
+        split_points = [self.select(i * self.total_size // count) for i in range(1, count)]
+        while len(self.shards) < count:
+            self.shards.append(self.__new_shard())
+        cuts = []
+        for index, shard in enumerate(self.shards):
+            if index >= count:
+                cuts.append([(None, None, (True, True))])
+                continue
+            cut = []
+            if index > 0:
+                cut.append((None, split_points[index - 1], (True, False)))
+            if index < count - 1:
+                cut.append((split_points[index], None, (True, True)))
+            cuts.append(cut)
+        for shard, cut in zip(self.shards, cuts):
+            for bounds in cut:
+                shard.send("pop_range", *bounds)
+        parts = [[] for _ in range(count)]
+        for shard, cut in zip(self.shards, cuts):
+            for _ in cut:
+                for item in shard.receive():
+                    parts[bisect.bisect_right(split_points, item[0])].append(item)
+        for shard in self.shards[count:]:
+            shard.close()
+        del self.shards[count:]
+        for shard, part in zip(self.shards, parts):
+            if part:
+                shard.send("put_many", part)
+        for shard, part in zip(self.shards, parts):
+            if part:
+                shard.receive()
+        self.split_points = split_points
+
+
+class BoundedCache:
+    """
+    Bounded map with TTL expiry and LRU or key-order eviction, built on two RedBlackTrees and a dict
+    The dict answers lookups in O(1) on average. One tree orders the entries for eviction: by last use with the
+    "lru" policy, by key with the "key" policy, which evicts the smallest key first. The other orders the entries
+    that have a TTL by expiry time. Evicting or expiring an entry takes the first key of a tree, O(log n).
+    A hit does not touch the trees: the entry only records its new use, and an entry found stale at the front of
+    the LRU order is moved back to its latest use instead of being evicted, so each hit costs O(log n) at most
+    once, later, and only when eviction reaches it
+    """
+    class Entry:
+        __slots__ = ("value", "size", "order_key", "stamp", "expiry_key")
+
+        def __init__(self, value, size, order_key, stamp, expiry_key):
+            self.value = value
+            self.size = size
+            #the key this entry has in the eviction order tree, and the stamp of its latest use
+            self.order_key = order_key
+            self.stamp = stamp
+            #(expiry time, stamp) in the expiry tree, or None when the entry does not expire
+            self.expiry_key = expiry_key
+
+    POLICIES = ("lru", "key")
+
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None, policy="lru", sizeof=None, clock=time.monotonic):
+        """
+        :param max_entries: the most entries kept, or None for no limit
+        :param max_bytes: the byte budget for the entries, or None for no limit
+        :param ttl: default time to live in seconds for new entries, or None for entries that do not expire
+        :param policy: "lru" to evict the least recently used entry, "key" to evict the smallest key
+        :param sizeof: function (key, value) -> bytes charged against max_bytes, sys.getsizeof of both by default
+        :param clock: function returning the current time in seconds
+        """
+        if policy not in self.POLICIES:
+            raise ValueError("policy must be 'lru' or 'key'")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.policy = policy
+        self.sizeof = sizeof if sizeof is not None else BoundedCache.__default_sizeof
+        self.clock = clock
+        self.entries = {}
+        self.order = RedBlackTree()
+        self.expiry = RedBlackTree()
+        self.total_bytes = 0
+        self.__stamp = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def __default_sizeof(key, value):
+        return sys.getsizeof(key) + sys.getsizeof(value)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and not self.__expired(key, entry)
+
+    def counters(self):
+        """
+        Returns the hit, miss, eviction and expiration counts
+        """
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "expirations": self.expirations}
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for the key and marks it as used, or default on a miss or an expired entry
+        :param key: the key to look up
+        :param default: the value returned on a miss
+        """
+        entry = self.entries.get(key)
+        if entry is None or self.__expired(key, entry):
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.__stamp += 1
+        entry.stamp = self.__stamp
+        return entry.value
+
+    def put(self, key, value, ttl=None):
+        """
+        Caches a value, replacing any earlier one for the key, then expires and evicts down to the limits
+        :param key: the key to cache under
+        :param value: the value to cache
+        :param ttl: time to live in seconds for this entry, defaulting to the cache's ttl
+        """
+        old = self.entries.get(key)
+        if old is not None:
+            self.__remove(key, old)
+        self.__stamp += 1
+        stamp = self.__stamp
+        order_key = stamp if self.policy == "lru" else key
+        if ttl is None:
+            ttl = self.ttl
+        expiry_key = None
+        if ttl is not None:
+            expiry_key = (self.clock() + ttl, stamp)
+            self.expiry.put(expiry_key, key)
+        size = self.sizeof(key, value)
+        self.entries[key] = self.Entry(value, size, order_key, stamp, expiry_key)
+        self.order.put(order_key, key)
+        self.total_bytes += size
+        self.expire()
+        self.__evict()
+
+    def delete(self, key):
+        """
+        Removes the key, returning its value, or None if it was not cached
+        :param key: the key to remove
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.__remove(key, entry)
+        return entry.value
+
+    def expire(self):
+        """
+        Removes every entry whose time to live has passed, returning how many were removed
+        """
+        expiry = self.expiry
+        if expiry.root is None:
+            return 0
+        now = self.clock()
+        removed = 0
+        #peeking at the cached minimum is O(1), and pop_min removes it with one pass down the left spine
+        while expiry.root is not None and not expiry.find_first_key()[0] > now:
+            first, key = expiry.pop_min()
+            entry = self.entries[key]
+            self.order.delete(entry.order_key)
+            self.__forget(key, entry)
+            removed += 1
+        self.expirations += removed
+        return removed
+
+    def __expired(self, key, entry):
+        # Drops the entry and returns True if its time to live has passed
+        if entry.expiry_key is None or entry.expiry_key[0] > self.clock():
+            return False
+        self.__remove(key, entry)
+        self.expirations += 1
+        return True
+
+    def __remove(self, key, entry):
+        self.order.delete(entry.order_key)
+        self.__drop(key, entry)
+
+    def __drop(self, key, entry):
+        # Removes an entry that is already off the eviction order tree
+        if entry.expiry_key is not None:
+            self.expiry.delete(entry.expiry_key)
+        self.__forget(key, entry)
+
+    def __forget(self, key, entry):
+        # Removes an entry that is already off both trees
+        del self.entries[key]
+        self.total_bytes -= entry.size
+
+    def __over_budget(self):
+        if self.max_entries is not None and len(self.entries) > self.max_entries:
+            return True
+        return self.max_bytes is not None and self.total_bytes > self.max_bytes
+
+    def __evict(self):
+        # Removes entries from the front of the eviction order until the cache is within its limits
+        order = self.order
+        while self.__over_budget():
+            first, key = order.pop_min()
+            entry = self.entries[key]
+            if entry.order_key != entry.stamp and self.policy == "lru":
+                #used since it was queued: move it back to its latest use instead
+                entry.order_key = entry.stamp
+                order.put(entry.stamp, key)
+                continue
+            self.__drop(key, entry)
+            self.evictions += 1
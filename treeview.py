@@ -0,0 +1,214 @@
+"""
+Rendering for the red black tree: a Tkinter window, and offscreen SVG and Graphviz DOT exports that need no display.
+Everything is drawn from one iterative layout that places the nodes in key order, so there is no recursion limit,
+and an optional depth cutoff collapses each subtree below it into a single marker counting its hidden nodes.
+That keeps a picture of a million-node tree's shape to a few thousand shapes
+
+RedBlackTree.display_tree(), to_svg() and to_dot() import this module on first use, so plain tree use never
+loads tkinter
+"""
+import collections
+import html
+
+#Spacing of the drawing in pixels: between neighbouring nodes, between levels, the node radius and the border
+NODE_SPACING = 24
+LEVEL_SPACING = 40
+RADIUS = 8
+MARGIN = 20
+#Above this many drawn nodes the SVG leaves out key labels unless they are asked for
+LABEL_LIMIT = 500
+
+#A placed node. x is its slot in key order, depth its level, parent the index of its parent in the layout (-1 for
+#the root), hidden the number of nodes collapsed into it by the depth cutoff, tombstones included, and tombstone
+#whether the node is an entry removed by lazy delete that is still linked into the tree
+PlacedNode = collections.namedtuple("PlacedNode", ("key", "red", "x", "depth", "parent", "hidden", "tombstone"))
+
+
+def layout(tree, max_depth=None):
+    """
+    Places the nodes of a tree for drawing in O(drawn nodes), returning a list of PlacedNode in pre-order
+    Nodes are given consecutive x slots in key order and their depth as y, which never lets subtrees overlap.
+    subtree_size only counts live entries, so while the tree holds tombstones the collapsed subtrees are walked
+    to count their nodes
+    :param tree: the RedBlackTree to lay out
+    :param max_depth: the deepest level drawn; a node there that has children stands in for its whole subtree.
+    None draws every node
+    """
+    from redblacktree import _TOMBSTONE
+
+    items = []
+    xs = []
+    stack = []
+
+    def descend(node, depth, parent):
+        # Creates the items down the left spine of node, stacking them to be given x slots in key order
+        while node is not None:
+            index = len(items)
+            collapsed = max_depth is not None and depth >= max_depth and (node.left is not None
+                                                                           or node.right is not None)
+            hidden = 0
+            if collapsed:
+                hidden = (_count_nodes(node) if tree.tombstones else node.subtree_size) - 1
+            items.append((node.key, not node.color, depth, parent, hidden, node.value is _TOMBSTONE))
+            xs.append(0)
+            if collapsed:
+                stack.append((None, index, depth))
+                return
+            stack.append((node, index, depth))
+            parent = index
+            node = node.left
+            depth += 1
+
+    descend(tree.root, 0, -1)
+    x = 0
+    while stack:
+        node, index, depth = stack.pop()
+        xs[index] = x
+        x += 1
+        if node is not None:
+            descend(node.right, depth + 1, index)
+    return [PlacedNode(key, red, xs[i], depth, parent, hidden, tombstone)
+            for i, (key, red, depth, parent, hidden, tombstone) in enumerate(items)]
+
+
+def _count_nodes(node):
+    # Number of nodes in a subtree, tombstones included, counted with an explicit stack
+    count = 0
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        count += 1
+        if node.left is not None:
+            stack.append(node.left)
+        if node.right is not None:
+            stack.append(node.right)
+    return count
+
+
+def _position(placed):
+    # Pixel coordinates of a placed node's centre
+    return MARGIN + RADIUS + placed.x * NODE_SPACING, MARGIN + RADIUS + placed.depth * LEVEL_SPACING
+
+
+def to_svg(tree, path=None, max_depth=None, labels=None):
+    """
+    Renders the tree as an SVG document, returning it as a string and writing it to path when one is given
+    Red and black nodes are drawn as circles, tombstones left by lazy delete as dashed rings in their color, and a
+    subtree cut off by max_depth as a grey triangle titled with the number of nodes it hides
+    :param tree: the RedBlackTree to render
+    :param path: optional file to write the SVG to
+    :param max_depth: the deepest level drawn, None for every level
+    :param labels: True or False to force key labels on or off, None to show them for small drawings only
+    """
+    placed = layout(tree, max_depth)
+    if labels is None:
+        labels = len(placed) <= LABEL_LIMIT
+    columns = max((p.x for p in placed), default=0) + 1
+    levels = max((p.depth for p in placed), default=0) + 1
+    width = 2 * (MARGIN + RADIUS) + (columns - 1) * NODE_SPACING
+    height = 2 * (MARGIN + RADIUS) + (levels - 1) * LEVEL_SPACING
+    out = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" viewBox="0 0 %d %d">'
+           % (width, height, width, height),
+           '<g stroke="#555" stroke-width="1">']
+    for p in placed:
+        if p.parent >= 0:
+            x, y = _position(p)
+            px, py = _position(placed[p.parent])
+            out.append('<line x1="%d" y1="%d" x2="%d" y2="%d"/>' % (px, py, x, y))
+    out.append('</g>')
+    for p in placed:
+        x, y = _position(p)
+        if p.hidden:
+            out.append('<polygon points="%d,%d %d,%d %d,%d" fill="#bbb"><title>%d hidden nodes</title></polygon>'
+                       % (x, y - RADIUS, x - RADIUS, y + RADIUS, x + RADIUS, y + RADIUS, p.hidden))
+        elif p.tombstone:
+            out.append('<circle cx="%d" cy="%d" r="%d" fill="white" stroke="%s" stroke-dasharray="3,2">'
+                       '<title>deleted</title></circle>' % (x, y, RADIUS, "red" if p.red else "black"))
+        else:
+            out.append('<circle cx="%d" cy="%d" r="%d" fill="%s"/>' % (x, y, RADIUS, "red" if p.red else "black"))
+        if labels:
+            out.append('<text x="%d" y="%d" font-size="9" text-anchor="middle" fill="#000">%s</text>'
+                       % (x, y - RADIUS - 2, html.escape(str(p.key))))
+    out.append('</svg>')
+    svg = "\n".join(out)
+    if path is not None:
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(svg)
+    return svg
+
+
+def to_dot(tree, path=None, max_depth=None):
+    """
+    Renders the tree as a Graphviz DOT digraph, returning it as a string and writing it to path when one is given
+    Graphviz does its own layout; a tombstone left by lazy delete becomes a dashed outline in its color, and a
+    subtree cut off by max_depth a grey triangle labelled with the number of nodes it hides
+    :param tree: the RedBlackTree to render
+    :param path: optional file to write the DOT source to
+    :param max_depth: the deepest level drawn, None for every level
+    """
+    placed = layout(tree, max_depth)
+    out = ["digraph RedBlackTree {", '    node [style=filled, fontcolor=white, shape=circle];']
+    for i, p in enumerate(placed):
+        label = str(p.key).replace("\\", "\\\\").replace('"', '\\"')
+        if p.hidden:
+            out.append('    n%d [label="%s\\n+%d", shape=triangle, fillcolor=gray, fontcolor=black];'
+                       % (i, label, p.hidden))
+        elif p.tombstone:
+            out.append('    n%d [label="%s", style=dashed, color=%s, fontcolor=black];'
+                       % (i, label, "red" if p.red else "black"))
+        else:
+            out.append('    n%d [label="%s", fillcolor=%s];' % (i, label, "red" if p.red else "black"))
+        if p.parent >= 0:
+            out.append("    n%d -> n%d;" % (p.parent, i))
+    out.append("}")
+    dot = "\n".join(out)
+    if path is not None:
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(dot)
+    return dot
+
+
+def display(tree, max_depth=None):
+    """
+    Shows the tree in a scrollable Tkinter window and blocks until it is closed
+    :param tree: the RedBlackTree to show
+    :param max_depth: the deepest level drawn, None for every level
+    """
+    import tkinter as tk
+
+    placed = layout(tree, max_depth)
+    if not placed:
+        return
+    columns = max(p.x for p in placed) + 1
+    levels = max(p.depth for p in placed) + 1
+    width = 2 * (MARGIN + RADIUS) + (columns - 1) * NODE_SPACING
+    height = 2 * (MARGIN + RADIUS) + (levels - 1) * LEVEL_SPACING
+
+    root_window = tk.Tk()
+    root_window.title("Red-Black Tree Visualization")
+    canvas = tk.Canvas(root_window, width=min(width, 1200), height=min(height, 800),
+                       scrollregion=(0, 0, width, height))
+    scroll_x = tk.Scrollbar(root_window, orient=tk.HORIZONTAL, command=canvas.xview)
+    scroll_y = tk.Scrollbar(root_window, orient=tk.VERTICAL, command=canvas.yview)
+    canvas.configure(xscrollcommand=scroll_x.set, yscrollcommand=scroll_y.set)
+    scroll_x.pack(side=tk.BOTTOM, fill=tk.X)
+    scroll_y.pack(side=tk.RIGHT, fill=tk.Y)
+    canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+    for p in placed:
+        if p.parent >= 0:
+            x, y = _position(p)
+            px, py = _position(placed[p.parent])
+            canvas.create_line(px, py, x, y)
+    for p in placed:
+        x, y = _position(p)
+        if p.hidden:
+            canvas.create_polygon(x, y - RADIUS, x - RADIUS, y + RADIUS, x + RADIUS, y + RADIUS, fill="gray")
+            canvas.create_text(x, y + RADIUS + 8, text="+%d" % p.hidden)
+        elif p.tombstone:
+            canvas.create_oval(x - RADIUS, y - RADIUS, x + RADIUS, y + RADIUS, fill="white",
+                               outline="red" if p.red else "black", dash=(3, 2))
+        else:
+            canvas.create_oval(x - RADIUS, y - RADIUS, x + RADIUS, y + RADIUS, fill="red" if p.red else "black")
+        canvas.create_text(x, y - RADIUS - 6, text=str(p.key))
+    root_window.mainloop()